@@ -0,0 +1,654 @@
+#!/usr/bin/env python
+
+import os, sys
+import gc
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import multiprocessing
+
+import tokens
+import trees
+import graph
+import vector
+import engine
+import mapfile
+import messages
+import generator
+import pathfinding
+
+from game import GameLoop
+
+# Usage {{{1
+# =====
+# ./benchmark.py [search] [size ...]
+# ./benchmark.py load [size]
+#
+# The search benchmark compares the search algorithms on the bundled maps and
+# on square maps of the given sizes, generated in each of the corpus patterns
+# (see generator.py).  Every algorithm answers the same queries, and the
+# routes they find are checked to make sure that they all cost the same.
+#
+# The load benchmark times how long it takes to load a randomly generated
+# square map of the given size (1000x1000 by default), both as a normal map
+# and as a compact one, and also how long it takes to load the compiled map.
+#
+# ./benchmark.py batch [size] [queries]
+#
+# The batch benchmark answers the same queries (1000 by default) on a
+# randomly generated square map of the given size (316x316 by default), once
+# with CompactA_Star in this process, and then with a BatchSearch using every
+# number of worker processes up to the number of cores.
+#
+# ./benchmark.py memory [size]
+#
+# The memory benchmark loads a randomly generated square map of the given
+# size (316x316 by default) with stored edges, implicit edges and compact
+# edges, and reports how much memory each takes per tile.  Each map is loaded
+# by a fresh interpreter running "./benchmark.py measure <path> <options>",
+# so every measurement starts from the same heap.  It also reports the size
+# of a single tile, edge, dot and vector.
+#
+# ./benchmark.py suite [output] [size ...]
+# ./benchmark.py compare <before> <after> [tolerance]
+#
+# The suite times map loading, searching, the priority queues, game updates
+# and interface frames, using corpus maps of the given sizes (32 and 100 by
+# default), and measures the memory used by the biggest open map.  The
+# results are written as JSON (to benchmark.json by default), along with the
+# commit they were measured at.  The interface is drawn with SDL's dummy
+# video driver, so no window is needed, and is skipped if pygame isn't
+# installed.
+#
+# Comparing two result files lists every benchmark that got more than the
+# given fraction slower (25% by default), and exits with an error if any did.
+# Searches that found different routes did different amounts of work, so
+# they're listed separately rather than compared.  This always happens with
+# depth-first search, because the order that it visits neighbors in depends
+# on where the tiles happen to be in memory.
+# }}}1
+
+# Search Comparison {{{1
+def get_cost(map, route):
+    return sum(map.get_edge(start, end).get_cost()
+               for start, end in zip(route[1:], route))
+
+def compare_searches(path, algorithms, queries=100, seed=0):
+    """ Times each of the given search algorithms on the same set of random
+    queries, and returns the total time that each one took. """
+
+    map = tokens.Map()
+    map.load(path)
+
+    randomizer = random.Random(seed)
+    tiles = [tile for tile in map if tile.is_active()]
+    pairs = [(randomizer.choice(tiles), randomizer.choice(tiles))
+             for query in range(queries)]
+
+    searches = [(name, Algorithm(map)) for name, Algorithm in algorithms]
+    times = dict((name, 0) for name, search in searches)
+
+    for source, target in pairs:
+        costs = set()
+
+        for name, search in searches:
+            start = time.time()
+            search.search(source, target)
+            times[name] += time.time() - start
+
+            costs.add(get_cost(map, search.get_route()))
+
+        assert len(costs) == 1, "Searches disagree: %s" % sorted(costs)
+
+    return times
+
+def time_load(path, compact=False, implicit=False):
+    """ Returns the number of tiles in the given map and the time it took to
+    load it. """
+
+    map = tokens.Map()
+
+    start = time.time()
+    map.load(path, compact, implicit=implicit)
+    return map.get_num_nodes(), time.time() - start
+
+def report(title, algorithms, times):
+    baseline = times[algorithms[0][0]]
+
+    print(title)
+    for name, Algorithm in algorithms:
+        speedup = baseline / times[name] if times[name] else float('inf')
+        print("    %-20s %8.3fs  %5.1fx" % (name, times[name], speedup))
+# }}}1
+
+# Memory Usage {{{1
+def get_memory():
+    """ Returns the resident memory of this process in bytes, or None if it
+    can't be found.  This only works on Linux. """
+
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except IOError:
+        return None
+
+    return pages * resource.getpagesize()
+
+def get_size(object):
+    """ Returns the size of the given object and its attribute dictionary,
+    if it has one. """
+
+    size = sys.getsizeof(object)
+    if hasattr(object, '__dict__'): size += sys.getsizeof(object.__dict__)
+    return size
+
+def get_object_sizes():
+    map = tokens.Map()
+    map.load("maps/simple.hex")
+    tile = map.get_home_tile()
+
+    return [("Tile", get_size(tile)),
+            ("Edge", get_size(graph.Edge(tile, tile))),
+            ("Dot", get_size(tokens.Dot(map))),
+            ("Vector", get_size(vector.Vector(1.0, 2.0)))]
+
+def measure_load(path, options):
+    """ Loads the given map and returns the number of tiles and how many
+    bytes of memory the map took, or None if memory can't be measured. """
+
+    gc.collect()
+    before = get_memory()
+
+    map = tokens.Map()
+    map.load(path, **options)
+
+    gc.collect()
+    after = get_memory()
+
+    if before is None or after is None: return None
+    return map.get_num_nodes(), after - before
+
+def measure_memory(path, **options):
+    """ Loads the given map in a new interpreter, and returns the number of
+    tiles and how many bytes the map takes per tile.  A forked process
+    wouldn't do, since it could reuse memory that this one has freed.
+    Returns None if memory can't be measured on this system. """
+
+    command = [sys.executable, os.path.abspath(__file__),
+               "measure", path, json.dumps(options)]
+    result = json.loads(subprocess.check_output(command))
+
+    if result is None: return None
+    tiles, bytes = result
+    return tiles, bytes / float(tiles)
+# }}}1
+
+# Benchmark Suite {{{1
+def best_time(function, repeats=5):
+    """ Calls the given function a few times and returns the fastest time. """
+
+    times = []
+
+    for repeat in range(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    return min(times)
+
+def get_queries(map, count, seed=0):
+    """ Returns the same random (source, target) pairs every time it's called
+    with the same map. """
+
+    randomizer = random.Random(seed)
+    tiles = [tile for tile in map if tile.is_active()]
+    return [(randomizer.choice(tiles), randomizer.choice(tiles))
+            for query in range(count)]
+
+def get_commit():
+    try:
+        command = ['git', 'rev-parse', 'HEAD']
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(command, stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_loading(corpus):
+    results = {}
+
+    for name, path in corpus:
+        compiled = mapfile.get_compiled_path(path)
+        map = tokens.Map()
+        map.load(path, compact=True, cache=True)
+
+        loads = [
+                ("load", path, False, False),
+                ("load-compact", path, True, False),
+                ("load-implicit", path, False, True),
+                ("load-compiled", compiled, True, False) ]
+
+        for label, source, compact, implicit in loads:
+            seconds = best_time(lambda: tokens.Map().load(
+                    source, compact, implicit=implicit))
+            results["%s/%s" % (label, name)] = {
+                    "seconds" : seconds,
+                    "tiles" : map.get_num_nodes() }
+
+    return results
+
+def time_searches(corpus, queries=20):
+    algorithms = [
+            ("a-star", pathfinding.A_Star),
+            ("breadth-first", pathfinding.BreadthFirstSearch),
+            ("depth-first", pathfinding.DepthFirstSearch) ]
+
+    results = {}
+
+    for name, path in corpus:
+        map = tokens.Map()
+        map.load(path)
+        pairs = get_queries(map, queries)
+
+        for label, Algorithm in algorithms:
+            search = Algorithm(map)
+
+            def answer_queries():
+                for source, target in pairs:
+                    search.search(source, target)
+
+            seconds = best_time(answer_queries)
+
+            found = length = 0
+            for source, target in pairs:
+                search.search(source, target)
+                found += search.was_target_found()
+                length += len(search.get_route())
+
+            results["search/%s/%s" % (label, name)] = {
+                    "seconds" : seconds,
+                    "queries" : len(pairs),
+                    "found" : found,
+                    "route-length" : length }
+
+    return results
+
+def time_queues(size=1000, operations=20000, seed=0):
+    """ Replays the same mix of pushes, pops and updates on each priority
+    queue.  Updates always lower an item's weight, like in a search. """
+
+    randomizer = random.Random(seed)
+    weights = {}
+    reference = trees.LazyIndexedPQ(weights)
+    script = []
+
+    # Every weight is different, so every queue pops the same items.
+    def push(item):
+        weights[item] = randomizer.random()
+        reference.push(item)
+        script.append(("push", item, weights[item]))
+
+    for item in range(size):
+        push(item)
+
+    for operation in range(operations):
+        choice = randomizer.random()
+
+        if choice < 0.4 or reference.empty():
+            push(size + operation)
+        elif choice < 0.8:
+            script.append(("pop",))
+            reference.pop()
+        else:
+            item = reference.peek()
+            weights[item] *= randomizer.random()
+            reference.update(item)
+            script.append(("update", item, weights[item]))
+
+    def replay(Queue):
+        weights = {}
+        queue = Queue(weights)
+
+        for operation in script:
+            if operation[0] == "pop":
+                queue.pop()
+            else:
+                kind, item, weight = operation
+                weights[item] = weight
+                if kind == "push": queue.push(item)
+                else: queue.update(item)
+
+    results = {}
+
+    for label, Queue in ("indexed", trees.IndexedPQ), \
+            ("lazy-indexed", trees.LazyIndexedPQ):
+        results["queue/%s" % label] = {
+                "seconds" : best_time(lambda: replay(Queue)),
+                "operations" : len(script) }
+
+    return results
+
+def time_game(path, dots=200, frames=100, seed=0):
+    """ Orders many dots across the map one at a time, and then times the
+    game loop while they move. """
+
+    world = tokens.World()
+    world.load(path)
+    map = world.get_map()
+
+    messenger = engine.Messenger()
+    loop = GameLoop(world, messenger)
+    loop.setup()
+
+    pairs = get_queries(map, dots, seed)
+
+    for source, target in pairs[1:]:
+        dot = tokens.Dot(map)
+        dot.load(source)
+        world.add_dot(dot)
+
+    start = time.time()
+    for dot, (source, target) in zip(world.get_dots(), pairs):
+        messenger.send(messages.MoveDot.type, messages.MoveDot([dot], target))
+    orders = time.time() - start
+
+    times = []
+    for frame in range(frames):
+        start = time.time()
+        loop.update(40)
+        times.append(time.time() - start)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    return {
+            "game/orders/%s" % name : {
+                "seconds" : orders, "dots" : dots },
+            "game/update/%s" % name : {
+                "seconds" : sum(times) / frames,
+                "worst" : max(times),
+                "frames" : frames,
+                "dots" : dots } }
+
+def time_interface(path, frames=50):
+    """ Times the interface loop without opening a window.  Nothing else in
+    the suite needs pygame, so it's only imported here. """
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    name = "interface/update/%s" % os.path.splitext(os.path.basename(path))[0]
+
+    try:
+        import pygame
+        from interface import InterfaceLoop
+    except ImportError as error:
+        return { name : { "skipped" : str(error) } }
+
+    world = tokens.World()
+    world.load(path)
+
+    loop = InterfaceLoop(world, engine.Messenger())
+    loop.setup()
+
+    times = []
+    for frame in range(frames):
+        start = time.time()
+        loop.update(40)
+        times.append(time.time() - start)
+
+    loop.teardown()
+    pygame.quit()
+
+    return { name : {
+        "seconds" : sum(times) / frames,
+        "worst" : max(times),
+        "frames" : frames } }
+
+def time_memory(name, path):
+    modes = [
+            ("edges", {}),
+            ("implicit", { "implicit" : True }),
+            ("compact", { "compact" : True }) ]
+
+    results = {}
+
+    for mode, options in modes:
+        label = "memory/%s/%s" % (mode, name)
+        result = measure_memory(path, **options)
+
+        if result is None:
+            results[label] = { "skipped" : "memory can't be measured" }
+        else:
+            tiles, bytes = result
+            results[label] = { "bytes-per-tile" : bytes, "tiles" : tiles }
+
+    return results
+
+def run_suite(sizes):
+    directory = tempfile.mkdtemp()
+    corpus = generator.write_corpus(directory, sizes)
+    results = {}
+
+    # The game is played on the biggest open map, and the interface is drawn
+    # for the smallest one.
+    maps = dict(corpus)
+    biggest, smallest = "open-%d" % max(sizes), "open-%d" % min(sizes)
+
+    try:
+        benchmarks = [
+                lambda: time_loading(corpus),
+                lambda: time_memory(biggest, maps[biggest]),
+                lambda: time_searches(corpus),
+                lambda: time_queues(),
+                lambda: time_game(maps[biggest]),
+                lambda: time_interface(maps[smallest]) ]
+
+        for benchmark in benchmarks:
+            for name, result in sorted(benchmark().items()):
+                print("    %-36s %s" % (name, format_result(result)))
+                sys.stdout.flush()
+                results[name] = result
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def format_result(result):
+    if "skipped" in result:
+        return "skipped (%s)" % result["skipped"]
+    if "bytes-per-tile" in result:
+        return "%8.0f bytes/tile" % result["bytes-per-tile"]
+    return "%8.4fs" % result["seconds"]
+
+def compare_results(before, after, tolerance=0.25):
+    """ Returns the name and slowdown of every benchmark that's more than the
+    given fraction slower after than it was before, and the names of the
+    searches that can't be compared because they found different routes. """
+
+    regressions = []
+    incomparable = []
+
+    for name in sorted(set(before) & set(after)):
+        old = before[name].get("seconds")
+        new = after[name].get("seconds")
+        if not old or new is None: continue
+
+        if before[name].get("route-length") != after[name].get("route-length"):
+            incomparable.append(name)
+        elif new / old > 1 + tolerance:
+            regressions.append((name, new / old))
+
+    return regressions, incomparable
+# }}}1
+
+def benchmark_searches(arguments):
+    algorithms = [
+            ("A*", pathfinding.A_Star),
+            ("Jump Point Search", pathfinding.JumpPointSearch) ]
+
+    sizes = [int(size) for size in arguments] or [30, 60, 100]
+
+    for path in ["maps/simple.hex", "maps/hole.hex"]:
+        times = compare_searches(path, algorithms)
+        report(path, algorithms, times)
+
+    directory = tempfile.mkdtemp()
+
+    for size in sizes:
+        for pattern, density in generator.corpus_patterns:
+            path = os.path.join(directory, "%s-%d.hex" % (pattern, size))
+            generator.generate_map(path, size, size, pattern, density)
+
+            times = compare_searches(path, algorithms)
+            title = "%dx%d %s, density %g" % (size, size, pattern, density)
+            report(title, algorithms, times)
+
+    shutil.rmtree(directory)
+
+def benchmark_batch(arguments):
+    size = int(arguments[0]) if arguments else 316
+    queries = int(arguments[1]) if len(arguments) > 1 else 1000
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "random-%d.hex" % size)
+    generator.generate_map(path, size, size)
+
+    map = tokens.Map()
+    map.load(path, compact=True)
+    pairs = get_queries(map, queries)
+
+    print("%dx%d, %d queries" % (size, size, queries))
+
+    search = pathfinding.CompactA_Star(map)
+    start = time.time()
+
+    for source, target in pairs:
+        search.search(source, target)
+
+    serial = time.time() - start
+    print("    %-20s %8.3fs" % ("CompactA_Star", serial))
+
+    for processes in range(1, multiprocessing.cpu_count() + 1):
+        batch = pathfinding.BatchSearch(map, processes)
+
+        start = time.time()
+        batch.search(pairs)
+        seconds = time.time() - start
+
+        batch.close()
+
+        name = "BatchSearch(%d)" % processes
+        print("    %-20s %8.3fs  %5.1fx" % (name, seconds, serial / seconds))
+        sys.stdout.flush()
+
+    shutil.rmtree(directory)
+
+def benchmark_loading(arguments):
+    size = int(arguments[0]) if arguments else 1000
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "random-%d.hex" % size)
+    generator.generate_map(path, size, size)
+
+    print("%dx%d" % (size, size))
+
+    compiled = mapfile.get_compiled_path(path)
+    map = tokens.Map()
+    map.load(path, compact=True, cache=True)
+    del map
+
+    # The compact maps are loaded first because they need much less memory.
+    loads = [
+            ("Map.load(compact)", path, True, False),
+            ("compiled, compact", compiled, True, False),
+            ("Map.load(implicit)", path, False, True),
+            ("Map.load()", path, False, False) ]
+
+    for name, path, compact, implicit in loads:
+        tiles, seconds = time_load(path, compact, implicit)
+        print("    %-20s %8.3fs  %d tiles" % (name, seconds, tiles))
+        sys.stdout.flush()
+
+    shutil.rmtree(directory)
+
+def benchmark_memory(arguments):
+    size = int(arguments[0]) if arguments else 316
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "random-%d.hex" % size)
+    generator.generate_map(path, size, size)
+
+    print("%dx%d" % (size, size))
+
+    loads = [
+            ("Map.load()", {}),
+            ("Map.load(implicit)", { "implicit" : True }),
+            ("Map.load(compact)", { "compact" : True }) ]
+
+    for name, options in loads:
+        result = measure_memory(path, **options)
+
+        if result is None:
+            sys.exit("Memory can't be measured on this system.")
+
+        tiles, bytes = result
+        print("    %-20s %8.0f bytes/tile  %d tiles" % (name, bytes, tiles))
+        sys.stdout.flush()
+
+    print("Objects")
+    for name, size in get_object_sizes():
+        print("    %-20s %8d bytes" % (name, size))
+
+    shutil.rmtree(directory)
+
+def benchmark_suite(arguments):
+    path = arguments.pop(0) if arguments and not arguments[0].isdigit() \
+            else "benchmark.json"
+    sizes = [int(size) for size in arguments] or [32, 100]
+
+    results = run_suite(sizes)
+
+    output = {
+            "commit" : get_commit(),
+            "python" : sys.version.split()[0],
+            "date" : time.strftime("%Y-%m-%d %H:%M:%S"),
+            "sizes" : sizes,
+            "results" : results }
+
+    with open(path, 'w') as file:
+        json.dump(output, file, indent=2, sort_keys=True)
+
+def benchmark_comparison(arguments):
+    if len(arguments) < 2:
+        sys.exit("Usage: ./benchmark.py compare <before> <after> [tolerance]")
+
+    with open(arguments[0]) as file: before = json.load(file)
+    with open(arguments[1]) as file: after = json.load(file)
+    tolerance = float(arguments[2]) if len(arguments) > 2 else 0.25
+
+    regressions, incomparable = compare_results(
+            before["results"], after["results"], tolerance)
+
+    for name, slowdown in regressions:
+        print("    %-36s %5.2fx slower" % (name, slowdown))
+    for name in incomparable:
+        print("    %-36s different routes" % name)
+
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+
+    arguments = sys.argv[1:]
+    command = arguments.pop(0) if arguments and not arguments[0].isdigit() \
+            else "search"
+
+    if command == "search": benchmark_searches(arguments)
+    elif command == "load": benchmark_loading(arguments)
+    elif command == "batch": benchmark_batch(arguments)
+    elif command == "memory": benchmark_memory(arguments)
+    elif command == "measure": print(json.dumps(measure_load(
+            arguments[0], json.loads(arguments[1]))))
+    elif command == "suite": benchmark_suite(arguments)
+    elif command == "compare": benchmark_comparison(arguments)
+    else: sys.exit("Unknown benchmark: %s" % command)
@@ -1,14 +1,180 @@
+import time
+
 class Messenger:
+    """ Passes messages from whoever sends them to every callback subscribed
+    to their type.  Normally each message is delivered as soon as it's sent.
+    A queued messenger holds on to messages until deliver() is called, which
+    the game loop does once per tick.
+
+    While queued, a message can be superseded by later messages of the same
+    type.  Messages that support this have two methods.  get_claims() returns
+    whatever the message claims, such as the dots it moves.  supersede() is
+    called with everything that later messages of its type have claimed,
+    and returns what's left of the message, or None if nothing is.  Only
+    what's left is delivered.  The claims are gathered in a single pass from
+    the newest message back to the oldest, so coalescing takes time in
+    proportion to the total size of the queued messages.
+
+    The messenger counts how many messages of each type are sent, delivered,
+    superseded and dropped for lack of subscribers, and how long their
+    callbacks take. """
 
-    def __init__(self):
+    def __init__(self, queued=False):
         self.callbacks = {}
 
+        self.queued = queued
+        self.queue = []
+
+        self.statistics = {}
+
+    def is_queued(self):
+        return self.queued
+    def set_queued(self, queued):
+        if not queued: self.deliver()
+        self.queued = queued
+
+    def get_backlog(self):
+        return len(self.queue)
+    def get_statistics(self):
+        """ Returns a dictionary of counters for each message type. """
+        return self.statistics
+
+    def get_counters(self, type):
+        """ Returns the counters for the given message type, creating them if
+        necessary.  This is a private method and should not be called
+        outside this class. """
+
+        try: return self.statistics[type]
+        except KeyError:
+            counters = self.statistics[type] = {
+                    "sent" : 0, "delivered" : 0, "superseded" : 0,
+                    "dropped" : 0, "seconds" : 0.0 }
+            return counters
+
     def send(self, type, message):
-        for callback in self.callbacks[type]:
+        self.get_counters(type)["sent"] += 1
+
+        if self.queued: self.queue.append((type, message))
+        else: self.dispatch(type, message)
+
+    def deliver(self):
+        """ Delivers every queued message, oldest first.  Messages sent while
+        this is happening wait for the next call. """
+
+        queue = self.coalesce(self.queue)
+        self.queue = []
+
+        for type, message in queue:
+            self.dispatch(type, message)
+
+    def coalesce(self, queue):
+        """ Returns the given queue without any messages that were superseded
+        by later ones.  This is a private method and should not be called
+        outside this class. """
+
+        coalesced = []
+        claimed = {}
+
+        for type, message in reversed(queue):
+            remaining = message
+
+            if hasattr(message, 'supersede'):
+                claims = claimed.setdefault(type, set())
+                remaining = message.supersede(claims)
+                claims.update(message.get_claims())
+
+            if remaining is None:
+                self.get_counters(type)["superseded"] += 1
+            else:
+                coalesced.append((type, remaining))
+
+        coalesced.reverse()
+        return coalesced
+
+    def dispatch(self, type, message):
+        """ Hands the given message to every callback subscribed to its type.
+        Messages that nobody is subscribed to are dropped.  This is a private
+        method and should not be called outside this class. """
+
+        counters = self.get_counters(type)
+        callbacks = self.callbacks.get(type)
+
+        if not callbacks:
+            counters["dropped"] += 1
+            return
+
+        start = time.time()
+
+        for callback in callbacks:
             callback(message)
 
+        counters["delivered"] += 1
+        counters["seconds"] += time.time() - start
+
     def subscribe(self, type, callback):
         if type not in self.callbacks:
             self.callbacks[type] = []
 
         self.callbacks[type].append(callback)
+
+class Scheduler:
+    """ Runs the simulation in fixed steps, no matter how long each frame
+    takes to draw.  The time between frames is saved up, and the simulation
+    takes as many steps as fit into it.  A slow frame is made up for with
+    extra steps in the next one, so the same input always gives the same
+    world.  If the simulation falls so far behind that it would need more
+    than the given number of steps, the time it can't catch up on is
+    dropped and the game just runs slower.
+
+    The display is updated once per frame, and is told how far it is
+    between the last step and the next one, as a fraction of a step. """
+
+    def __init__(self, simulation, display=None, tick=25, steps=5):
+        self.simulation = simulation
+        self.display = display
+
+        self.tick = tick
+        self.steps = steps
+
+        self.ticks = 0
+        self.leftover = 0
+
+    def get_tick(self):
+        return self.tick
+    def get_ticks(self):
+        return self.ticks
+    def get_alpha(self):
+        return self.leftover / float(self.tick)
+
+    def get_loops(self):
+        if self.display is None: return [self.simulation]
+        return [self.simulation, self.display]
+
+    def setup(self):
+        for loop in self.get_loops():
+            loop.setup()
+
+    def update(self, time):
+        """ Advances the simulation by the given number of milliseconds, and
+        then draws a frame.  Returns the number of steps that were taken. """
+
+        self.leftover += time
+        steps = 0
+
+        while self.leftover >= self.tick and steps < self.steps:
+            self.simulation.update(self.tick)
+            self.leftover -= self.tick
+            self.ticks += 1
+            steps += 1
+
+        if self.leftover >= self.tick:
+            self.leftover %= self.tick
+
+        if self.display is not None:
+            self.display.update(time, self.get_alpha())
+
+        return steps
+
+    def teardown(self):
+        for loop in self.get_loops():
+            loop.teardown()
@@ -1,6 +1,10 @@
+import time
+
 import messages
 import pathfinding
 
+from collections import OrderedDict
+
 class GameLoop:
 
     def __init__(self, world, messenger):
@@ -8,30 +12,243 @@ class GameLoop:
         self.messenger = messenger
 
         self.pathfinder = None
+        self.route_cache = None
+        self.flow_fields = None
+
+        # Orders given to at least this many dots at once are routed using a
+        # flow field, rather than with a separate search for each dot.
+        self.group_size = 2
+
+        # When replanning, every dot keeps an incremental planner for as long
+        # as it's moving, and its route is repaired whenever the map changes.
+        self.replanning = False
+
+        # When either budget is set, searches are spread across frames.  Each
+        # update advances the pending searches, oldest first, by at most this
+        # many expansions and this many milliseconds in total.
+        self.pending = OrderedDict()
+        self.expansion_budget = None
+        self.time_budget = None
+
+    def get_route_cache(self):
+        return self.route_cache
+    def get_flow_fields(self):
+        return self.flow_fields
+    def get_group_size(self):
+        return self.group_size
+    def is_replanning(self):
+        return self.replanning
+
+    def get_search_budget(self):
+        return self.expansion_budget, self.time_budget
+    def is_time_slicing(self):
+        return self.expansion_budget is not None or self.time_budget is not None
+
+    def get_backlog(self):
+        return len(self.pending)
+    def get_pending(self):
+        """ Returns a (dot, target, pathfinder) tuple for every search that
+        hasn't finished yet.  Dots ordered in a group share a flow field
+        rather than a pathfinder.  Either can be asked how many nodes it has
+        expanded so far. """
+        return [(dot, target, pathfinder)
+                for dot, (source, target, pathfinder, generation)
+                in self.pending.items()]
+
+    def set_group_size(self, size):
+        self.group_size = size
+    def set_replanning(self, replanning):
+        self.replanning = replanning
+    def set_search_budget(self, expansions=None, milliseconds=None):
+        self.expansion_budget = expansions
+        self.time_budget = milliseconds
 
     def setup(self):
         map = self.world.get_map()
-        self.pathfinder = pathfinding.A_Star(map)
+        self.pathfinder = self.create_pathfinder()
+        self.route_cache = pathfinding.RouteCache(map)
+        self.flow_fields = pathfinding.FlowFieldCache(map)
 
         type = messages.MoveDot.type
         self.messenger.subscribe(type, self.move_dot)
 
     def update(self, time):
-        for dot in self.world.get_dots():
-            dot.update(time)
+        self.messenger.deliver()
+        self.advance_searches()
+
+        self.world.update(time)
+
+        for dot in self.world.get_planned_dots():
+            planner = dot.get_planner()
+
+            if dot.get_target() is None:
+                planner.detach()
+                dot.set_planner(self, None)
+
+            elif planner.has_changes():
+                self.repair_route(dot, planner)
 
     def teardown(self):
         pass
 
     def move_dot(self, message):
+        target = message.target
+
+        # New orders replace any search still pending for the same dots.
+        for dot in message.dots:
+            self.pending.pop(dot, None)
+
+        if self.replanning:
+            for dot in message.dots:
+                self.plan_route(dot, target)
+            return
+
+        # When time slicing, a flow field that isn't cached yet is built
+        # under the same budget as every other search.
+        group = len(message.dots) >= self.group_size
+        if group:
+            field = self.flow_fields.lookup(target, not self.is_time_slicing())
+
         for dot in message.dots:
             source = dot.get_position()
-            target = message.target
+            dot.set_target(self, target)
 
-            pathfinder = self.pathfinder
-            pathfinder.search(source, target)
+            if group and field.is_searching():
+                self.queue_search(dot, source, target, field)
+                continue
 
-            route = pathfinder.get_route()
+            if group:
+                route = field.get_route(source)
+            else:
+                route = self.route_cache.lookup(source, target)
+
+            if route is None and self.is_time_slicing():
+                self.queue_search(dot, source, target)
+                continue
+
+            if route is None:
+                route = self.search_route(source, target)
 
             dot.set_route(self, route)
-            dot.set_target(self, target)
+
+    def create_pathfinder(self):
+        map = self.world.get_map()
+
+        if map.is_compact():
+            return pathfinding.CompactA_Star(map)
+        else:
+            return pathfinding.A_Star(map)
+
+    def search_route(self, source, target):
+        pathfinder = self.pathfinder
+        pathfinder.search(source, target)
+
+        route = pathfinder.get_route()
+        self.route_cache.store(source, target, route)
+
+        return route
+
+    def queue_search(self, dot, source, target, field=None):
+        """ Starts a search that will be advanced a little bit every update.
+        The dot stops where it is until its new route is ready.  Dots in a
+        group wait for the given flow field instead, which they share.
+
+        The map's generation is saved with the search, so that a search
+        which was started before the map changed is never finished. """
+
+        if field is None:
+            pathfinder = self.create_pathfinder()
+            pathfinder.start(source, target)
+            generation = self.world.get_map().get_generation()
+        else:
+            pathfinder = field
+            generation = field.get_generation()
+
+        self.pending[dot] = source, target, pathfinder, generation
+        dot.set_route(self, [])
+
+    def restart_search(self, dot):
+        """ Starts the given dot's pending search over on the map as it is
+        now, without moving it to the back of the queue.  Dots in a group
+        move on to the flow field for the new generation, which the rest of
+        their group will share too. """
+
+        source, target, pathfinder, generation = self.pending[dot]
+
+        if isinstance(pathfinder, pathfinding.FlowField):
+            pathfinder = self.flow_fields.lookup(target, False)
+            generation = pathfinder.get_generation()
+        else:
+            pathfinder.start(source, target)
+            generation = self.world.get_map().get_generation()
+
+        self.pending[dot] = source, target, pathfinder, generation
+
+    def advance_searches(self):
+        pending = self.pending
+        expansions = self.expansion_budget
+        deadline = None
+
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget / 1000.0
+
+        current = self.world.get_map().get_generation()
+
+        while pending:
+            dot = next(iter(pending))
+
+            # Routes found on an older map could go through tiles that have
+            # since become impassable, and mustn't be cached either.
+            if pending[dot][3] != current:
+                self.restart_search(dot)
+
+            source, target, pathfinder, generation = pending[dot]
+
+            count = pathfinder.resume(expansions, deadline)
+            if expansions is not None: expansions -= count
+
+            if pathfinder.is_searching():
+                break
+
+            del pending[dot]
+
+            if isinstance(pathfinder, pathfinding.FlowField):
+                route = pathfinder.get_route(source)
+            else:
+                route = pathfinder.get_route()
+                self.route_cache.store(source, target, route)
+
+            dot.set_route(self, route)
+
+    def repair_route(self, dot, planner):
+        """ Asks the given dot's planner for a new route after the map has
+        changed.  The dot is already on the last tile of the new route, so
+        that tile is dropped, and the step the dot is taking is kept.  The
+        route is only replaced if it's actually different, since any change
+        anywhere on the map wakes the planner up. """
+
+        position = dot.get_position()
+        planner.search(position, dot.get_target())
+
+        route = planner.get_route()
+        if route and route[-1] == position:
+            route = route[:-1]
+
+        if route != dot.get_route():
+            dot.set_route(self, route)
+
+    def plan_route(self, dot, target):
+        planner = dot.get_planner()
+
+        if planner and planner.get_target() != target:
+            planner.detach()
+            planner = None
+
+        if not planner:
+            planner = pathfinding.DStarLite(self.world.get_map())
+
+        planner.search(dot.get_position(), target)
+
+        dot.set_planner(self, planner)
+        dot.set_route(self, planner.get_route())
+        dot.set_target(self, target)
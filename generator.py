@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+import os, sys
+import random
+
+# Usage {{{1
+# =====
+# ./generator.py <pattern> <rows> <columns> [density] [seed] > map.hex
+# ./generator.py corpus [directory]
+#
+# The first form writes a single map to stdout.  The second writes the
+# benchmark corpus (see below) into the given directory, which defaults to
+# maps/corpus.  The corpus is generated from fixed seeds, so it's the same
+# every time and doesn't need to be kept in the repository.
+# }}}1
+
+# Patterns {{{1
+# ========
+# open      Obstacles are scattered at random.  Each tile is an obstacle with
+#           probability equal to the density.
+#
+# islands   Obstacles are clumped together into round islands, which are
+#           added until about the given fraction of the map is covered.
+#
+# maze      A maze with one tile wide corridors.  The density is the fraction
+#           of the leftover walls that are knocked down, so a density of 0
+#           gives a perfect maze and higher densities give more loops.
+#
+# rooms     Rooms of different sizes separated by walls, with one doorway
+#           between each pair of neighboring rooms.  Each tile inside a room
+#           is an obstacle with probability equal to the density.
+# }}}1
+
+clear = 'F'
+blocked = ' '
+home = 'H'
+
+# Map Generation {{{1
+def generate_map(path, rows, columns, pattern='open', density=0.1, seed=0):
+    """ Writes a map with the given dimensions to the given path.  The home
+    tile is always in the top left corner. """
+
+    with open(path, 'w') as file:
+        write_map(file, rows, columns, pattern, density, seed)
+
+def write_map(file, rows, columns, pattern='open', density=0.1, seed=0):
+    """ Writes a generated map to the given file object. """
+
+    if columns < 2:
+        raise ValueError("Maps need at least two columns.")
+
+    generator = random.Random(seed)
+    grid = patterns[pattern](rows, columns, density, generator)
+
+    for row, tiles in enumerate(grid):
+        if row == 0: tiles[0] = home
+
+        # Map.read_file() needs at least one clear tile in every row.
+        if clear not in tiles:
+            tiles[-1] = clear
+
+        indent = ' ' if row % 2 else ''
+        file.write(indent + ' '.join(tiles) + '\n')
+
+def open_field(rows, columns, density, generator):
+    return [[blocked if generator.random() < density else clear
+             for column in range(columns)]
+            for row in range(rows)]
+
+def islands(rows, columns, density, generator):
+    grid = [[clear] * columns for row in range(rows)]
+
+    goal = density * rows * columns
+    covered = 0
+
+    # Island sizes are scaled to the map, but are never less than one tile.
+    largest = max(1, min(rows, columns) // 10)
+
+    while covered < goal:
+        radius = generator.randint(1, largest)
+        center_row = generator.randrange(rows)
+        center_column = generator.randrange(columns)
+
+        top = max(0, center_row - radius)
+        bottom = min(rows, center_row + radius + 1)
+        left = max(0, center_column - radius)
+        right = min(columns, center_column + radius + 1)
+
+        for row in range(top, bottom):
+            for column in range(left, right):
+                dy = row - center_row; dx = column - center_column
+                if dx * dx + dy * dy > radius * radius: continue
+
+                if grid[row][column] == clear:
+                    grid[row][column] = blocked
+                    covered += 1
+
+    return grid
+
+def maze(rows, columns, density, generator):
+    """ Cells sit at even rows and columns, and the tiles between them are
+    walls until the maze is carved.  In this layout, two tiles in the same
+    column of neighboring rows are always neighbors, so corridors can run
+    straight up and down as well as across. """
+
+    grid = [[blocked] * columns for row in range(rows)]
+
+    cell_rows = (rows + 1) // 2
+    cell_columns = (columns + 1) // 2
+
+    def neighbors(cell):
+        row, column = cell
+        for dy, dx in (-1, 0), (1, 0), (0, -1), (0, 1):
+            if 0 <= row + dy < cell_rows and 0 <= column + dx < cell_columns:
+                yield row + dy, column + dx
+
+    def carve(cell, other=None):
+        row, column = cell
+        grid[2 * row][2 * column] = clear
+
+        if other is not None:
+            grid[row + other[0]][column + other[1]] = clear
+
+    # Carve a perfect maze with a depth-first search.
+    start = (0, 0)
+    visited = set([start])
+    stack = [start]
+    carve(start)
+
+    while stack:
+        cell = stack[-1]
+        unvisited = [other for other in neighbors(cell)
+                     if other not in visited]
+
+        if not unvisited:
+            stack.pop()
+            continue
+
+        other = generator.choice(unvisited)
+        visited.add(other)
+        stack.append(other)
+        carve(other, cell)
+
+    # Knock down some of the remaining walls to make loops.
+    for row in range(cell_rows):
+        for column in range(cell_columns):
+            for other in (row + 1, column), (row, column + 1):
+                if other[0] >= cell_rows or other[1] >= cell_columns:
+                    continue
+                if generator.random() < density:
+                    carve(other, (row, column))
+
+    return grid
+
+def rooms(rows, columns, density, generator):
+    """ Rooms are made by recursive division.  Walls are only built on even
+    rows and columns, and doorways are only left on odd ones, so that a wall
+    never ends right in front of another wall's doorway. """
+
+    grid = [[clear] * columns for row in range(rows)]
+    doorways = set()
+
+    # Rooms smaller than this aren't divided any further.
+    smallest = 6
+
+    regions = [(0, 0, rows - 1, columns - 1)]
+
+    while regions:
+        top, left, bottom, right = regions.pop()
+        height = bottom - top + 1
+        width = right - left + 1
+
+        if max(height, width) < 2 * smallest + 1:
+            continue
+
+        if height > width:
+            walls = range(top + smallest, bottom - smallest + 1)
+            walls = [row for row in walls if row % 2 == 0]
+            doors = [column for column in range(left, right + 1)
+                     if column % 2 == 1]
+
+            if not walls or not doors: continue
+
+            wall = generator.choice(walls)
+            door = generator.choice(doors)
+
+            for column in range(left, right + 1):
+                grid[wall][column] = blocked
+
+            grid[wall][door] = clear
+            doorways.add((wall, door))
+
+            regions.append((top, left, wall - 1, right))
+            regions.append((wall + 1, left, bottom, right))
+
+        else:
+            walls = range(left + smallest, right - smallest + 1)
+            walls = [column for column in walls if column % 2 == 0]
+            doors = [row for row in range(top, bottom + 1) if row % 2 == 1]
+
+            if not walls or not doors: continue
+
+            wall = generator.choice(walls)
+            door = generator.choice(doors)
+
+            for row in range(top, bottom + 1):
+                grid[row][wall] = blocked
+
+            grid[door][wall] = clear
+            doorways.add((door, wall))
+
+            regions.append((top, left, bottom, wall - 1))
+            regions.append((top, wall + 1, bottom, right))
+
+    # Scatter some clutter around the rooms, but keep the doorways clear.
+    for row in range(rows):
+        for column in range(columns):
+            if grid[row][column] != clear: continue
+            if (row, column) in doorways: continue
+
+            if generator.random() < density:
+                grid[row][column] = blocked
+
+    return grid
+
+patterns = {
+        'open' : open_field,
+        'islands' : islands,
+        'maze' : maze,
+        'rooms' : rooms }
+
+# Benchmark Corpus {{{1
+# ================
+# Every pattern at four sizes, from about a thousand to a million tiles.
+
+corpus_sizes = [32, 100, 316, 1000]
+corpus_patterns = [
+        ('open', 0.2),
+        ('islands', 0.2),
+        ('maze', 0.1),
+        ('rooms', 0.05) ]
+
+def get_corpus(directory, sizes=None):
+    """ Returns the name and path of every map in the corpus, smallest
+    first, without generating any of them. """
+
+    return [("%s-%d" % (pattern, size),
+             os.path.join(directory, "%s-%d.hex" % (pattern, size)))
+            for size in sizes or corpus_sizes
+            for pattern, density in corpus_patterns]
+
+def write_corpus(directory, sizes=None):
+    """ Generates the corpus into the given directory, and returns the same
+    list as get_corpus(). """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    densities = dict(corpus_patterns)
+    corpus = get_corpus(directory, sizes)
+
+    for name, path in corpus:
+        pattern, size = name.split('-')
+        generate_map(path, int(size), int(size), pattern, densities[pattern])
+
+    return corpus
+# }}}1
+
+if __name__ == "__main__":
+
+    arguments = sys.argv[1:]
+
+    if arguments and arguments[0] == 'corpus':
+        directory = arguments[1] if len(arguments) > 1 else "maps/corpus"
+        for name, path in write_corpus(directory):
+            print(path)
+
+    elif len(arguments) >= 3 and arguments[0] in patterns:
+        pattern = arguments[0]
+        rows, columns = int(arguments[1]), int(arguments[2])
+        density = float(arguments[3]) if len(arguments) > 3 else 0.1
+        seed = int(arguments[4]) if len(arguments) > 4 else 0
+
+        write_map(sys.stdout, rows, columns, pattern, density, seed)
+
+    else:
+        sys.exit("Usage: ./generator.py <%s> <rows> <columns> "
+                 "[density] [seed]\n"
+                 "       ./generator.py corpus [directory]"
+                 % '|'.join(sorted(patterns)))
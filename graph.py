@@ -1,10 +1,17 @@
+from array import array
+
 # Node {{{1
-class Node:
+class Node(object):
+
+    # Maps can have millions of nodes and edges, so neither class gives its
+    # instances an attribute dictionary.
+    __slots__ = ('index', 'graph', 'weight', 'active')
 
     UNSET_INDEX = -1
 
     def __init__(self, weight):
         self.index = Node.UNSET_INDEX
+        self.graph = None
         self.weight = weight
         
         self.activate()
@@ -14,6 +21,8 @@ class Node:
 
     def get_index(self):
         return self.index
+    def get_graph(self):
+        return self.graph
     def get_weight(self):
         assert self.weight
         return self.weight
@@ -21,19 +30,26 @@ class Node:
     def set_index(self, index):
         assert self.get_index() == Node.UNSET_INDEX
         self.index = index
+    def set_graph(self, graph):
+        self.graph = graph
     def set_weight(self, weight):
         self.weight = weight
+        if self.graph: self.graph.weight_changed(self)
 
     def is_active(self):
         return self.active
 
     def activate(self):
         self.active = True
+        if self.graph: self.graph.activity_changed(self)
     def deactivate(self):
         self.active = False
+        if self.graph: self.graph.activity_changed(self)
 
 # Edge {{{1
-class Edge:
+class Edge(object):
+
+    __slots__ = ('start', 'end', 'distance')
 
     def __init__(self, start, end, distance=1):
         self.set_nodes(start, end)
@@ -76,17 +92,24 @@ class SparseGraph:
         self.nodes = []
         self.edges = {}
 
+        # Incremented whenever a node changes in a way that could affect the
+        # results of a search, so that cached routes can be thrown out.
+        # Listeners are told exactly which node changed.
+        self.generation = 0
+        self.listeners = []
+
     def __iter__(self):
         for node in self.nodes:
             yield node
 
     def add_node(self, node):
-        if node in self.nodes:
+        if node.get_graph() is self:
             message = "This node is already in the graph at position #%d."
-            raise KeyError(message % self.nodes.index(node))
+            raise KeyError(message % node.get_index())
 
         index = len(self.nodes)
         node.set_index(index)
+        node.set_graph(self)
         self.nodes.append(node)
 
         return index
@@ -103,6 +126,24 @@ class SparseGraph:
     def expand_node(self, node):
         pass
 
+    def get_generation(self):
+        return self.generation
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def weight_changed(self, node):
+        self.generation += 1
+        for listener in self.listeners:
+            listener.node_changed(node)
+
+    def activity_changed(self, node):
+        self.generation += 1
+        for listener in self.listeners:
+            listener.node_changed(node)
+
     def get_node(self, index):
         return self.nodes[index]
     def get_nodes(self):
@@ -111,7 +152,7 @@ class SparseGraph:
         return len(self.nodes)
 
     def get_index(self, node):
-        return self.nodes.index(node)
+        return node.get_index()
     def index_exists(self, index):
         return index < len(self.nodes)
 
@@ -130,4 +171,104 @@ class SparseGraph:
 
     def get_neighbors(self, node, cache_ok=True):
         return (edge.get_end() for edge in self.get_edges_from(node))
+
+# Compact Graph {{{1
+class CompactGraph:
+    """ Array-backed adjacency structure in compressed sparse row form.  The
+    neighbors of node i are stored in neighbors[offsets[i]:offsets[i+1]], and
+    the cost of each of those edges is stored at the same position in costs.
+    Nodes are identified by their index, but the original node objects are
+    kept around so that Edge objects can be handed out as views.
+
+    Only unit-distance edges are supported, so the cost of an edge is always
+    the product of its endpoint weights.  This is what tokens.Map builds.
+
+    The weight, activity and cost arrays are normally calculated from the
+    nodes, but they can also be given directly (e.g. as views into a compiled
+    map file).  Anything that supports indexing will do. """
+
+    def __init__(self, nodes, offsets, neighbors,
+            weights=None, active=None, costs=None):
+
+        self.nodes = nodes
+        self.offsets = offsets
+        self.neighbors = neighbors
+
+        if weights is None:
+            weights = array('d', (node.get_weight() for node in nodes))
+        if active is None:
+            active = bytearray(node.is_active() for node in nodes)
+
+        self.weights = weights
+        self.active = active
+
+        if costs is None:
+            self.costs = array('d', [0]) * len(neighbors)
+            for index in range(len(nodes)):
+                self.reweigh(index)
+        else:
+            self.costs = costs
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_node(self, index):
+        return self.nodes[index]
+    def get_nodes(self):
+        return self.nodes
+    def get_num_nodes(self):
+        return len(self.nodes)
+    def get_num_edges(self):
+        return len(self.neighbors)
+
+    def get_arrays(self):
+        return self.offsets, self.neighbors, self.costs, self.active
+
+    def is_active(self, index):
+        return self.active[index]
+    def set_active(self, index, active):
+        self.active[index] = active
+
+    def set_weight(self, index, weight):
+        self.weights[index] = weight
+        self.reweigh(index)
+
+    def reweigh(self, index):
+        """ Recalculates the costs of every edge into or out of the given
+        node.  Edges always come in pairs, so the edges into a node are found
+        by looking for it among the neighbors of its neighbors. """
+
+        offsets = self.offsets
+        neighbors = self.neighbors
+        weights = self.weights
+        costs = self.costs
+
+        for position in range(offsets[index], offsets[index + 1]):
+            neighbor = neighbors[position]
+            cost = weights[index] * weights[neighbor]
+            costs[position] = cost
+
+            for twin in range(offsets[neighbor], offsets[neighbor + 1]):
+                if neighbors[twin] == index:
+                    costs[twin] = cost
+
+    def get_neighbor_indices(self, index):
+        neighbors = self.neighbors
+        offsets = self.offsets
+        return neighbors[offsets[index]:offsets[index + 1]]
+
+    def get_edges_from(self, node):
+        nodes = self.nodes
+        return [Edge(node, nodes[neighbor])
+                for neighbor in self.get_neighbor_indices(node.get_index())]
+
+    def get_edge(self, start, end):
+        if end.get_index() not in self.get_neighbor_indices(start.get_index()):
+            raise KeyError(end)
+        return Edge(start, end)
+
+    def get_neighbors(self, node):
+        nodes = self.nodes
+        return (nodes[neighbor]
+                for neighbor in self.get_neighbor_indices(node.get_index()))
 # }}}1
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import os, sys
+import random
+import time
+
+import engine
+import tokens
+import messages
+
+from game import GameLoop
+
+# Usage {{{1
+# =====
+# ./headless.py [map] [dots] [ticks] [seed]
+#
+# Runs the game without a window, and without ever importing pygame, so that
+# big simulations can be run on servers and in CI.  The given number of dots
+# (1000 by default) are spread across the map (maps/hole.hex by default) and
+# given scripted orders, and the game loop is stepped as fast as it will go
+# for the given number of ticks (1000 by default).
+#
+# Every few ticks, a random group of dots is ordered to a random tile.  The
+# orders only depend on the seed, so two runs with the same arguments play
+# out exactly the same.  Afterwards, the runner reports how many ticks and
+# searches it managed per second, how long orders took to handle, and how
+# much time was spent in the handlers for each type of message.  Each dot in
+# an order counts as one search, whether its route came from a real search,
+# the route cache or a flow field.
+# }}}1
+
+# Scripted Orders {{{1
+def spawn_dots(world, count, generator):
+    """ Adds the given number of dots to the world, on random active tiles.
+    The world's own dot counts towards the total. """
+
+    map = world.get_map()
+    tiles = [tile for tile in map if tile.is_active()]
+
+    for index in range(count - len(world.get_dots())):
+        dot = tokens.Dot(map)
+        dot.load(generator.choice(tiles))
+        world.add_dot(dot)
+
+def script_orders(world, ticks, generator, interval=5, group=10):
+    """ Returns a dictionary that maps ticks to the MoveDot orders given on
+    them.  An order goes out every few ticks, to between one and the given
+    number of dots. """
+
+    map = world.get_map()
+    dots = world.get_dots()
+    tiles = [tile for tile in map if tile.is_active()]
+
+    orders = {}
+
+    for tick in range(0, ticks, interval):
+        size = generator.randint(1, min(group, len(dots)))
+        chosen = generator.sample(dots, size)
+        target = generator.choice(tiles)
+
+        orders[tick] = messages.MoveDot(chosen, target)
+
+    return orders
+
+# Simulation {{{1
+def simulate(path, dots=1000, ticks=1000, seed=0):
+    """ Runs the scripted game, and returns a dictionary of statistics.  The
+    latencies are the number of seconds each order took to handle. """
+
+    generator = random.Random(seed)
+
+    world = tokens.World()
+    world.load(path, compact=True)
+
+    spawn_dots(world, dots, generator)
+    orders = script_orders(world, ticks, generator)
+
+    messenger = engine.Messenger()
+    loop = GameLoop(world, messenger)
+
+    scheduler = engine.Scheduler(loop)
+    scheduler.setup()
+
+    step = scheduler.get_tick()
+    latencies = []
+    searches = 0
+
+    start = time.time()
+
+    for tick in range(ticks):
+        order = orders.get(tick)
+
+        if order is not None:
+            sent = time.time()
+            messenger.send(order.type, order)
+            latencies.append(time.time() - sent)
+            searches += len(order.dots)
+
+        scheduler.update(step)
+
+    elapsed = time.time() - start
+    scheduler.teardown()
+
+    moving = sum(1 for dot in world.get_dots() if dot.get_route())
+
+    return {
+            "ticks" : scheduler.get_ticks(),
+            "seconds" : elapsed,
+            "searches" : searches,
+            "search seconds" : sum(latencies),
+            "latencies" : latencies,
+            "messages" : messenger.get_statistics(),
+            "dots" : len(world.get_dots()),
+            "moving" : moving }
+
+# Reporting {{{1
+def get_percentile(values, fraction):
+    """ Returns the value that the given fraction of the values are no bigger
+    than, using the nearest rank. """
+
+    if not values: return 0
+
+    values = sorted(values)
+    rank = int(round(fraction * (len(values) - 1)))
+    return values[rank]
+
+def format_report(path, results):
+    ticks = results["ticks"]
+    seconds = results["seconds"]
+    searches = results["searches"]
+    search_seconds = results["search seconds"]
+    latencies = results["latencies"]
+
+    lines = [
+            "%s, %d dots (%d still moving)" % (
+                path, results["dots"], results["moving"]),
+            "    %-20s %10.1f" % ("ticks/s", ticks / seconds),
+            "    %-20s %10.1f" % ("searches/s",
+                searches / search_seconds if search_seconds else 0),
+            "    %-20s %10d" % ("orders", len(latencies)) ]
+
+    for label, fraction in ("p50", 0.5), ("p90", 0.9), ("p99", 0.99), \
+            ("max", 1.0):
+        latency = get_percentile(latencies, fraction)
+        lines.append("    %-20s %8.2fms" % ("latency " + label,
+            latency * 1000))
+
+    # Which message handlers the time went to.
+    for type, counters in sorted(results["messages"].items()):
+        lines.append("    %-20s %10d %8.3fs" % (type,
+            counters["delivered"], counters["seconds"]))
+
+    return '\n'.join(lines)
+# }}}1
+
+if __name__ == "__main__":
+
+    arguments = sys.argv[1:]
+
+    path = arguments[0] if len(arguments) > 0 else "maps/hole.hex"
+    dots = int(arguments[1]) if len(arguments) > 1 else 1000
+    ticks = int(arguments[2]) if len(arguments) > 2 else 1000
+    seed = int(arguments[3]) if len(arguments) > 3 else 0
+
+    if not os.path.exists(path):
+        sys.exit("No such map: %s" % path)
+
+    results = simulate(path, dots, ticks, seed)
+    print(format_report(path, results))
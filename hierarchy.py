@@ -0,0 +1,444 @@
+import trees
+import pathfinding
+
+# Hierarchical Pathfinding {{{1
+# ========================
+# Large maps are split into square clusters of tiles.  Wherever two clusters
+# touch, each unbroken stretch of passable border gets one transition (or
+# two, at its ends, if it's long): a pair of tiles, one on either side, that
+# routes are allowed to cross the border through.  The tiles in these pairs
+# are the entrances of their clusters.
+#
+# The abstract graph has an edge for every transition, and an edge between
+# every pair of entrances in the same cluster that can reach each other
+# without leaving it.  Searching this small graph picks which clusters a
+# route passes through, and then only the legs within those clusters have to
+# be searched tile by tile.
+#
+# The routes found this way are usually close to, but not always exactly,
+# the shortest possible routes.
+# }}}1
+
+# Abstraction {{{1
+class Abstraction:
+
+    # Runs of border at least this long get a transition at each end, rather
+    # than just one in the middle.
+    long_border = 6
+
+    def __init__(self, map, size=10):
+        self.map = map
+        self.size = size
+
+        self.clusters = {}
+        self.transitions = {}
+        self.entrances = {}
+
+        # The abstract graph.  Paths connect entrances within a cluster, and
+        # links connect entrances across transitions.
+        self.paths = {}
+        self.links = {}
+
+        self.dirty = set()
+
+        for tile in map:
+            key = self.get_cluster(tile)
+            self.clusters.setdefault(key, set()).add(tile)
+
+        for key in self.clusters:
+            self.entrances[key] = set()
+
+        for key in self.clusters:
+            for other in self.get_neighboring_clusters(key):
+                if key < other: self.build_transitions(key, other)
+
+        for key in self.clusters:
+            self.build_paths(key)
+
+        map.add_listener(self)
+
+    # Attributes {{{2
+    def get_map(self):
+        return self.map
+    def get_size(self):
+        return self.size
+
+    def get_cluster(self, tile):
+        row, column = tile.get_position()
+        return row // self.size, column // self.size
+
+    def get_clusters(self):
+        return self.clusters
+    def get_entrances(self, key):
+        return self.entrances[key]
+    def get_transitions(self):
+        return self.transitions
+
+    def get_num_entrances(self):
+        return sum(len(entrances) for entrances in self.entrances.values())
+
+    def get_neighboring_clusters(self, key):
+        row, column = key
+        neighbors = [(row + dy, column + dx)
+                     for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                     if dy or dx]
+        return [neighbor for neighbor in neighbors
+                if neighbor in self.clusters]
+    # }}}2
+
+    # Updates {{{2
+    def node_changed(self, tile):
+        """ Called by the map whenever a tile is activated, deactivated or
+        reweighed.  Only the cluster containing that tile is marked for
+        rebuilding, and nothing is actually rebuilt until the next query. """
+
+        self.dirty.add(self.get_cluster(tile))
+
+    def refresh(self):
+        """ Rebuilds every cluster that has changed since the last query.
+        The transitions along the borders of a changed cluster are rebuilt as
+        well, which may change the entrances of its neighbors, so those
+        neighbors get their paths rebuilt too. """
+
+        if not self.dirty:
+            return
+
+        rebuild = set(self.dirty)
+
+        for key in self.dirty:
+            for other in self.get_neighboring_clusters(key):
+                before = set(self.entrances[other])
+                self.build_transitions(key, other)
+
+                if self.entrances[other] != before:
+                    rebuild.add(other)
+
+        for key in rebuild:
+            self.build_paths(key)
+
+        self.dirty = set()
+
+    def build_transitions(self, key, other):
+        """ Finds the transitions across the border between two clusters. """
+
+        pair = (key, other) if key < other else (other, key)
+        first, second = pair
+
+        new_transitions = []
+
+        for start, end in self.transitions.pop(pair, []):
+            del self.links[start][end]
+            del self.links[end][start]
+
+        # Find every edge that crosses the border.
+        crossings = []
+        tiles = self.clusters[second]
+
+        for tile in self.clusters[first]:
+            for edge in self.map.get_edges_from(tile):
+                if edge.get_end() in tiles and edge.is_active():
+                    crossings.append((tile, edge.get_end()))
+
+        # Split the crossings into unbroken runs.
+        for run in self.split_runs(crossings):
+            if len(run) >= self.long_border:
+                new_transitions += [run[0], run[-1]]
+            else:
+                new_transitions.append(run[len(run) // 2])
+
+        if new_transitions:
+            self.transitions[pair] = new_transitions
+
+        for start, end in new_transitions:
+            cost = self.map.get_edge(start, end).get_cost()
+            self.links.setdefault(start, {})[end] = cost
+            self.links.setdefault(end, {})[start] = cost
+
+        # Recalculate the entrances of both clusters.
+        for cluster in pair:
+            entrances = set()
+
+            for neighbor in self.get_neighboring_clusters(cluster):
+                key = (cluster, neighbor) if cluster < neighbor \
+                        else (neighbor, cluster)
+
+                for start, end in self.transitions.get(key, []):
+                    entrances.add(start if start in self.clusters[cluster]
+                                  else end)
+
+            self.entrances[cluster] = entrances
+
+    def split_runs(self, crossings):
+        """ Groups border crossings that are next to each other.  Two
+        crossings are next to each other if the tiles on both sides of the
+        border are either the same or neighbors.  This guarantees that any
+        one crossing in a run can be reached from all the others without
+        leaving the two clusters. """
+
+        crossings = list(crossings)
+        runs = []
+
+        def touching(first, second):
+            return first == second or second in self.map.get_neighbors(first)
+
+        while crossings:
+            run = [crossings.pop(0)]
+
+            grew = True
+            while grew:
+                grew = False
+
+                for crossing in crossings[:]:
+                    start, end = crossing
+
+                    for other_start, other_end in run:
+                        if touching(start, other_start) and \
+                                touching(end, other_end):
+                            run.append(crossing)
+                            crossings.remove(crossing)
+                            grew = True
+                            break
+
+            runs.append(run)
+
+        return runs
+
+    def build_paths(self, key):
+        """ Finds the cost of getting between every pair of entrances within
+        the given cluster. """
+
+        tiles = self.clusters[key]
+        entrances = self.entrances[key]
+
+        for entrance in list(self.paths):
+            if entrance in tiles: del self.paths[entrance]
+
+        for entrance in entrances:
+            costs, parents = search_cluster(self.map, tiles, entrance)
+            self.paths[entrance] = dict(
+                    (other, costs[other])
+                    for other in entrances
+                    if other in costs and other != entrance)
+    # }}}2
+
+    # Abstract Graph {{{2
+    def get_abstract_edges(self, entrance):
+        """ Yields (neighbor, cost) pairs for the given entrance. """
+
+        for other, cost in self.paths.get(entrance, {}).items():
+            yield other, cost
+
+        for other, cost in self.links.get(entrance, {}).items():
+            yield other, cost
+    # }}}2
+# }}}1
+
+# Hierarchical A* {{{1
+class HierarchicalA_Star(pathfinding.SearchAlgorithm):
+    """ Answers queries by searching the abstract graph of an Abstraction,
+    and then only searching tile by tile within the clusters along the
+    chosen route.  Queries within a single cluster are handed to A_Star. """
+
+    def __init__(self, graph, size=10):
+        pathfinding.SearchAlgorithm.__init__(self)
+        self.graph = graph
+        self.abstraction = Abstraction(graph, size)
+        self.fallback = pathfinding.A_Star(graph)
+
+    def get_abstraction(self):
+        return self.abstraction
+
+    def search(self, source, target):
+        abstraction = self.abstraction
+        abstraction.refresh()
+
+        source_cluster = abstraction.get_cluster(source)
+        target_cluster = abstraction.get_cluster(target)
+
+        if source_cluster == target_cluster:
+            self.fallback_search(source, target)
+            return
+
+        pathfinding.SearchAlgorithm.search(self, source, target)
+
+        waypoints = self.search_abstraction(source, target)
+
+        if waypoints is None:
+            self.target_not_found({})
+            return
+
+        routes = {}
+
+        for start, end in zip(waypoints, waypoints[1:]):
+            routes.update(self.refine(start, end))
+
+        self.target_found(routes, source, target)
+
+    def fallback_search(self, source, target):
+        fallback = self.fallback
+        fallback.search(source, target)
+
+        self.route = fallback.get_route()
+        self.routes = fallback.get_routes()
+
+        self.found = fallback.was_target_found()
+        self.searching = False
+        self.search_time = fallback.get_search_time()
+
+    def search_abstraction(self, source, target):
+        """ Finds the entrances that the route should pass through.  The
+        source and target are temporarily connected to the entrances of their
+        own clusters.  Returns the list of waypoints from the source to the
+        target, or None if there is no route. """
+
+        abstraction = self.abstraction
+        map = self.graph
+        heuristic = map.heuristic
+
+        clusters = abstraction.get_clusters()
+        source_key = abstraction.get_cluster(source)
+        target_key = abstraction.get_cluster(target)
+
+        # Connect the source to the entrances of its cluster.
+        costs, parents = search_cluster(map, clusters[source_key], source)
+        starts = dict((entrance, costs[entrance])
+                      for entrance in abstraction.get_entrances(source_key)
+                      if entrance in costs)
+
+        # Connect the entrances of the target's cluster to the target.
+        costs, parents = search_cluster(map, clusters[target_key], target)
+        finishes = dict((entrance, costs[entrance])
+                        for entrance in abstraction.get_entrances(target_key)
+                        if entrance in costs)
+
+        real_costs = { source : 0 }
+        estimated_costs = { source : heuristic(source, target) }
+        previous = { source : source }
+
+        frontier_nodes = trees.IndexedPQ(estimated_costs)
+        frontier_nodes.push(source)
+
+        closed = set()
+
+        while not frontier_nodes.empty():
+            closest_node = frontier_nodes.pop()
+            closed.add(closest_node)
+
+            if closest_node == target:
+                waypoints = [target]
+                while waypoints[-1] != source:
+                    waypoints.append(previous[waypoints[-1]])
+
+                waypoints.reverse()
+                return waypoints
+
+            # The source may also be an entrance, so it gets the edges of
+            # both.  Every other node is an entrance.
+            edges = list(abstraction.get_abstract_edges(closest_node))
+
+            if closest_node == source:
+                edges += starts.items()
+            if closest_node in finishes:
+                edges.append((target, finishes[closest_node]))
+
+            for end, cost in edges:
+                if end in closed: continue
+
+                real_cost = real_costs[closest_node] + cost
+
+                if end in frontier_nodes:
+                    if real_cost < real_costs[end]:
+                        real_costs[end] = real_cost
+                        estimated_costs[end] = \
+                                real_cost + heuristic(end, target)
+
+                        previous[end] = closest_node
+                        frontier_nodes.update(end)
+                else:
+                    real_costs[end] = real_cost
+                    estimated_costs[end] = real_cost + heuristic(end, target)
+
+                    previous[end] = closest_node
+                    frontier_nodes.push(end)
+
+        return None
+
+    def refine(self, start, end):
+        """ Returns the tile by tile route between two consecutive waypoints,
+        in the form expected by target_found(). """
+
+        abstraction = self.abstraction
+        key = abstraction.get_cluster(start)
+
+        # Consecutive waypoints in different clusters are always neighbors.
+        if key != abstraction.get_cluster(end):
+            return { end : start }
+
+        tiles = abstraction.get_clusters()[key]
+        costs, parents = search_cluster(self.graph, tiles, start, end)
+
+        routes = {}
+        tile = end
+
+        while tile != start:
+            routes[tile] = parents[tile]
+            tile = parents[tile]
+
+        return routes
+# }}}1
+
+# Cluster Search {{{1
+def search_cluster(map, tiles, source, target=None):
+    """ Runs Dijkstra's algorithm from the given source without leaving the
+    given set of tiles.  If a target is given, the search is guided towards
+    it by the map's heuristic (i.e. it becomes A*) and stops as soon as it's
+    reached.  Returns the cost of getting to every tile that was reached and
+    the tile that each was reached from. """
+
+    costs = { source : 0 }
+    parents = { source : source }
+
+    if target is None:
+        heuristic = lambda tile, target: 0
+    else:
+        heuristic = map.heuristic
+
+    estimated_costs = { source : heuristic(source, target) }
+
+    frontier_nodes = trees.IndexedPQ(estimated_costs)
+    frontier_nodes.push(source)
+
+    closed = set()
+
+    while not frontier_nodes.empty():
+        closest_node = frontier_nodes.pop()
+        closed.add(closest_node)
+
+        if closest_node == target:
+            break
+
+        for edge in map.get_edges_from(closest_node):
+            end = edge.get_end()
+
+            if end not in tiles: continue
+            if end in closed: continue
+            if not edge.is_active(): continue
+
+            cost = costs[closest_node] + edge.get_cost()
+
+            if end in frontier_nodes:
+                if cost < costs[end]:
+                    costs[end] = cost
+                    estimated_costs[end] = cost + heuristic(end, target)
+
+                    parents[end] = closest_node
+                    frontier_nodes.update(end)
+            else:
+                costs[end] = cost
+                estimated_costs[end] = cost + heuristic(end, target)
+
+                parents[end] = closest_node
+                frontier_nodes.push(end)
+
+    return costs, parents
+# }}}1
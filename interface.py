@@ -19,11 +19,12 @@ class InterfaceLoop:
         self.messenger = messenger
 
         self.screen = None
+        self.tick = 0
 
         map = self.world.get_map()
         dots = self.world.get_dots()
 
-        self.geometry = Geometry(map, 30)
+        self.geometry = Geometry(world, 30)
         self.controls = Controls(dots)
         self.style = Style()
         self.layers = Layers()
@@ -43,6 +44,13 @@ class InterfaceLoop:
     def get_messenger(self):
         return self.messenger
 
+    def get_tick(self):
+        return self.tick
+    def set_tick(self, tick):
+        """ Sets the length of a simulation step, in milliseconds.  Moving
+        dots are only drawn between tiles if this is known. """
+        self.tick = tick
+
     def get_dimensions(self):
         return self.screen.get_size()
 
@@ -75,7 +83,7 @@ class InterfaceLoop:
         for artist in self.artists:
             artist.load()
 
-    def update(self, time):
+    def update(self, time, alpha=0):
 
         background = self.style.for_background()
         self.screen.fill(background)
@@ -91,7 +99,7 @@ class InterfaceLoop:
         # Draw the next frame.
         for layer in self.layers:
             for artist in self.artists:
-                artist.draw(self.screen, layer, time)
+                artist.draw(self.screen, layer, time, alpha)
 
         # Flip the display buffers.
         pygame.display.flip()
@@ -103,8 +111,9 @@ class InterfaceLoop:
 # Geometry {{{1
 class Geometry:
 
-    def __init__(self, map, side):
-        self.map = map
+    def __init__(self, world, side):
+        self.world = world
+        self.map = world.get_map()
         self.side = side
 
     def get_side(self):
@@ -149,13 +158,24 @@ class Geometry:
     # }}}2
 
     # Dot and Tile Conversions {{{2
-    def dot_to_point(self, dot):
-        tile = dot.get_position()
-        return self.tile_to_point(tile)
+    def dot_to_point(self, dot, elapsed=0):
+        """ Returns the point where the given dot should be drawn.  A moving
+        dot is drawn part of the way to the next tile on its route, based on
+        how long it's been moving plus the given number of milliseconds. """
 
-    def dot_to_circle(self, dot, scale=1):
-        tile = dot.get_position()
-        return self.tile_to_circle(tile, scale)
+        point = self.tile_to_point(dot.get_position())
+        next = dot.get_next_position()
+
+        if next is None:
+            return point
+
+        fraction = min(1, (dot.get_progress() + elapsed) / dot.get_speed())
+        return point + (self.tile_to_point(next) - point) * fraction
+
+    def dot_to_circle(self, dot, scale=1, elapsed=0):
+        center = self.dot_to_point(dot, elapsed)
+        radius = self.width * scale
+        return center, radius
 
     def dot_to_outline(self, dot, stroke, pad=0):
         tile = dot.get_position()
@@ -208,9 +228,35 @@ class Geometry:
 
     # Coordinate Conversions {{{2
     def point_to_dot(self, x, y):
-        tile = self.point_to_tile(x, y)
-        # Return the dot on this tile, if there is one.
-        raise NotImplementedError
+        """ Returns the dot on the tile under the given point, or None if the
+        tile is empty, impassable or off the map. """
+
+        try: tile = self.point_to_tile(x, y)
+        except (tokens.TileException, KeyError, IndexError): return None
+
+        dots = self.world.get_dots_on(tile)
+        return dots[-1] if dots else None
+
+    def rectangle_to_dots(self, left, top, right, bottom):
+        """ Returns every dot whose center is inside the given rectangle.
+        Only the tiles that the rectangle covers are checked. """
+
+        first_row = int(top // self.grid_height) - 1
+        last_row = int(bottom // self.grid_height) + 1
+        first_column = int(left // self.grid_width) - 1
+        last_column = int(right // self.grid_width) + 1
+
+        indices = self.map.get_rectangle(
+                first_row, first_column, last_row + 1, last_column + 1)
+
+        dots = []
+
+        for dot in self.world.get_dots_in(indices):
+            point = self.dot_to_point(dot)
+            if left <= point.x <= right and top <= point.y <= bottom:
+                dots.append(dot)
+
+        return dots
 
     def point_to_tile(self, x, y):
         row = int(y / self.grid_height)
@@ -344,7 +390,7 @@ class MapArtist:
 
             self.tiles.append((points, fill, outline, stroke))
 
-    def draw(self, screen, layer, time):
+    def draw(self, screen, layer, time, alpha):
         layers = self.gui.get_layers()
 
         for points, fill, outline, stroke in self.tiles:
@@ -363,17 +409,20 @@ class DotArtist:
     def load(self):
         pass
 
-    def draw(self, screen, layer, time):
+    def draw(self, screen, layer, time, alpha):
 
         style = self.gui.get_style()
         geometry = self.gui.get_geometry()
         layers = self.gui.get_layers()
 
+        # How far into the next simulation step this frame is.
+        elapsed = alpha * self.gui.get_tick()
+
         if layers.drawing_dots(layer):
 
             for dot in self.dots:
                 fill, scale, outline, stroke = style.for_dot()
-                center, radius = geometry.dot_to_circle(dot, scale)
+                center, radius = geometry.dot_to_circle(dot, scale, elapsed)
 
                 center = center.get_int_tuple()
                 radius = int(radius)
@@ -390,7 +439,7 @@ class SelectionArtist:
     def load(self):
         pass
 
-    def draw(self, screen, layer, time):
+    def draw(self, screen, layer, time, alpha):
         helpers = self.gui.get_helpers()
         geometry, controls, style, layers = helpers
 
@@ -451,7 +500,7 @@ class PracticeArtist:
 
         self.points = [point.get_int_tuple() for point in points]
 
-    def draw(self, screen, layer, time):
+    def draw(self, screen, layer, time, alpha):
         pass
 
 # }}}1
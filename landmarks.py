@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+import os, sys
+import mmap
+import heapq
+import struct
+import ctypes
+
+from array import array
+
+import mapfile
+
+# Landmarks {{{1
+# =========
+# Weighted tiles make the hex distance a weak heuristic, since it has to
+# assume that every step costs as little as the cheapest tile.  The ALT
+# heuristic does better by measuring the real cost from a few landmark tiles
+# to every other tile ahead of time.  By the triangle inequality, the cost
+# from any tile v to a target t is at least |d(L, t) - d(L, v)| for every
+# landmark L.
+#
+# Finding the landmarks takes one Dijkstra search per landmark over the whole
+# map, so it's done offline:
+#
+#   ./landmarks.py [-k count] map.hex ...
+#
+# The tables are saved next to the map, with the extension below, and are
+# memory-mapped when the map is loaded.  Nothing is read until the first
+# time the heuristic is used.
+#
+# The tables stay admissible as long as tiles only get more expensive or
+# impassable, because the real costs can only go up.  If a tile becomes
+# cheaper than it was when the tables were made, they're no longer used.
+#
+# Everything is little-endian.  The header is followed by these sections, in
+# order, each padded to a multiple of 8 bytes:
+#
+#   landmarks   count x int32           The index of each landmark tile.
+#   weights     tiles x float64         The weights the tables were made with.
+#   active      tiles x uint8
+#   distances   (tiles x count) float64 The cost from each landmark to each
+#                                       tile, by tile.  Unreachable tiles
+#                                       are marked with -1.
+# }}}1
+
+magic = 'HEXL'
+version = 1
+extension = '.hexl'
+
+header = struct.Struct('<4sIIIQd')
+unreachable = -1
+
+def get_landmarks_path(path):
+    """ Returns the path where the landmarks of the given map are saved. """
+    return os.path.splitext(path)[0] + extension
+
+# Landmark File {{{1
+class LandmarkFile:
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            try: self.buffer = mmap.mmap(
+                    file.fileno(), 0, access=mmap.ACCESS_COPY)
+            except ValueError:
+                raise mapfile.MapFileError(path, "file is empty")
+
+        if len(self.buffer) < header.size:
+            raise mapfile.MapFileError(path, "file is too short")
+
+        fields = header.unpack_from(self.buffer)
+
+        if fields[0] != magic:
+            raise mapfile.MapFileError(path, "not a landmark file")
+        if fields[1] != version:
+            raise mapfile.MapFileError(path, "version %d, expected %d" % (
+                fields[1], version))
+
+        (self.count, self.tiles,
+                self.source_size, self.source_mtime) = fields[2:]
+
+        self.position = mapfile.padded(header.size)
+
+        self.landmarks = self.read(ctypes.c_int32, self.count)
+        self.weights = self.read(ctypes.c_double, self.tiles)
+        self.active = self.read(ctypes.c_uint8, self.tiles)
+        self.distances = self.read(ctypes.c_double, self.tiles * self.count)
+
+        if self.position > len(self.buffer):
+            raise mapfile.MapFileError(path, "file is truncated")
+
+    def read(self, type, count):
+        """ Returns an array that views the next section of the file.  This
+        is a private method and should not be called outside this class. """
+
+        position = self.position
+        self.position += mapfile.padded(ctypes.sizeof(type) * count)
+
+        if self.position > len(self.buffer):
+            return None
+
+        return (type * count).from_buffer(self.buffer, position)
+
+    # Attributes {{{2
+    def get_count(self):
+        return self.count
+    def get_num_tiles(self):
+        return self.tiles
+    def get_landmarks(self):
+        return self.landmarks
+    def get_weights(self):
+        return self.weights
+    def get_active(self):
+        return self.active
+    def get_distances(self):
+        return self.distances
+
+    def is_stale(self, source):
+        """ Returns true if the given map file has changed since these
+        landmarks were found. """
+
+        try: status = os.stat(source)
+        except OSError: return False
+
+        return (status.st_size, status.st_mtime) != \
+                (self.source_size, self.source_mtime)
+    # }}}2
+
+# Landmarks {{{1
+class Landmarks:
+    """ The ALT heuristic for one map.  The landmark file is only opened the
+    first time a bound is asked for.  If it can't be used (because it's
+    missing, broken, out of date or made for a different map) every bound is
+    zero, so the map falls back on its own heuristic.
+
+    The landmarks listen to their map, and stop being used as soon as any
+    tile becomes cheaper than it was when the tables were made. """
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source
+
+        self.file = None
+        self.loaded = False
+        self.valid = False
+
+        self.count = 0
+        self.distances = None
+
+        # The row of the most recent target, since a search asks about the
+        # same target over and over.
+        self.target = None
+        self.target_row = None
+
+    def load(self, map):
+        """ Opens the landmark file and checks that it fits the given map.
+        This is a private method and should not be called outside this
+        class. """
+
+        self.loaded = True
+
+        try: file = LandmarkFile(self.path)
+        except (IOError, mapfile.MapFileError): return
+
+        if self.source and file.is_stale(self.source): return
+        if file.get_num_tiles() != map.get_num_nodes(): return
+
+        self.file = file
+        self.count = file.get_count()
+        self.distances = file.get_distances()
+
+        # Tiles may have changed before the tables were loaded.
+        weights, active = map.get_weights(), map.get_active()
+        self.valid = self.count > 0 and not any(
+                weights[index] < weight or active[index] and not flag
+                for index, (weight, flag) in enumerate(
+                    zip(file.get_weights(), file.get_active())))
+
+    # Attributes {{{2
+    def get_path(self):
+        return self.path
+    def get_count(self):
+        return self.count
+    def get_landmarks(self):
+        return list(self.file.get_landmarks()) if self.file else []
+
+    def is_loaded(self):
+        return self.loaded
+    def is_valid(self):
+        return self.valid
+    # }}}2
+
+    def check(self, map):
+        """ Opens the landmark file if that hasn't happened yet, and returns
+        true if its tables can be used with the given map. """
+
+        if not self.loaded: self.load(map)
+        return self.valid
+
+    def get_bound(self, map, end, target):
+        """ Returns a lower bound on the cost of getting from one tile index
+        to another. """
+
+        if not self.loaded: self.load(map)
+        if not self.valid: return 0
+
+        count = self.count
+        distances = self.distances
+
+        if target != self.target:
+            self.target = target
+            self.target_row = distances[target * count:(target + 1) * count]
+
+        return get_bound(distances, count, end, self.target_row)
+
+    def node_changed(self, tile):
+        if not self.valid: return
+
+        index = tile.get_index()
+        weight = self.file.get_weights()[index]
+        active = self.file.get_active()[index]
+
+        if tile.get_weight() < weight or tile.is_active() and not active:
+            self.valid = False
+            tile.get_graph().heuristic_changed()
+
+def get_bound(distances, count, end, target_row):
+    """ Returns the largest difference between the given tile's row of the
+    distance table and the target's row. """
+
+    row = distances[end * count:(end + 1) * count]
+    return max(abs(distance - other)
+               for distance, other in zip(row, target_row))
+
+# Preprocessing {{{1
+def find_distances(offsets, neighbors, costs, active, source):
+    """ Runs Dijkstra's algorithm from the given tile index over adjacency
+    arrays like graph.CompactGraph's, and returns the cost of reaching every
+    tile.  Unreachable tiles are given a cost of -1. """
+
+    distances = array('d', [unreachable]) * len(active)
+    distances[source] = 0
+
+    frontier = [(0, source)]
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+
+    while frontier:
+        distance, index = heappop(frontier)
+        if distance > distances[index]: continue
+
+        for position in range(offsets[index], offsets[index + 1]):
+            neighbor = neighbors[position]
+            if not active[neighbor]: continue
+
+            cost = distance + costs[position]
+            known = distances[neighbor]
+
+            if known == unreachable or cost < known:
+                distances[neighbor] = cost
+                heappush(frontier, (cost, neighbor))
+
+    return distances
+
+def choose_landmarks(map, count):
+    """ Picks landmarks that are spread out as far as possible, and returns
+    them along with their distance tables.  The first landmark is the tile
+    farthest from the home tile (or the first active tile), and every other
+    one is the tile farthest from all of the landmarks so far.  Landmarks are
+    only picked from the tiles that can reach the first one. """
+
+    offsets, neighbors, costs = map.get_adjacency()
+    active = map.get_active()
+
+    home = map.get_home_tile()
+    starts = [home.get_index()] if home else []
+    starts += [index for index, flag in enumerate(active) if flag][:1]
+
+    starts = [index for index in starts if active[index]]
+    if not starts: return [], []
+    start = starts[0]
+
+    def search(source):
+        return find_distances(offsets, neighbors, costs, active, source)
+
+    def farthest(distances):
+        return max(range(len(distances)), key=distances.__getitem__)
+
+    landmarks = [farthest(search(start))]
+    tables = [search(landmarks[0])]
+
+    # The distance from each reachable tile to its closest landmark.
+    closest = array('d', tables[0])
+
+    while len(landmarks) < count:
+        landmark = farthest(closest)
+        if closest[landmark] <= 0: break
+
+        landmarks.append(landmark)
+        tables.append(search(landmark))
+
+        for index, distance in enumerate(tables[-1]):
+            if distance < closest[index]: closest[index] = distance
+
+    return landmarks, tables
+
+def write(path, map, count=8, source=None):
+    """ Finds landmarks for the given tokens.Map, and saves their tables to
+    the given path.  Like mapfile.write(), the size and modification time of
+    the source are recorded if it's given, and the file is written under a
+    temporary name first. """
+
+    landmarks, tables = choose_landmarks(map, count)
+    tiles = map.get_num_nodes()
+
+    if source is not None:
+        status = os.stat(source)
+        source_size, source_mtime = status.st_size, status.st_mtime
+    else:
+        source_size, source_mtime = 0, 0
+
+    temporary = path + '.tmp'
+
+    with open(temporary, 'wb') as file:
+        def pad(size):
+            file.write('\0' * (mapfile.padded(size) - size))
+
+        file.write(header.pack(magic, version, len(landmarks), tiles,
+                source_size, source_mtime))
+        pad(header.size)
+
+        sections = [
+                ('i', landmarks),
+                ('d', map.get_weights()),
+                ('B', map.get_active()) ]
+
+        for code, values in sections:
+            data = struct.pack('<%d%s' % (len(values), code), *values)
+            file.write(data); pad(len(data))
+
+        # The tables are written one tile at a time, with every landmark's
+        # distance to that tile together.
+        row = struct.Struct('<%dd' % len(landmarks))
+        for index in range(tiles):
+            file.write(row.pack(*[table[index] for table in tables]))
+        pad(row.size * tiles)
+
+    os.rename(temporary, path)
+# }}}1
+
+if __name__ == "__main__":
+
+    import tokens
+
+    arguments = sys.argv[1:]
+    count = 8
+
+    if arguments[:1] == ['-k']:
+        count = int(arguments[1])
+        arguments = arguments[2:]
+
+    # Find landmarks for every map given on the command line.
+    for path in arguments:
+        map = tokens.Map()
+        map.load(path, compact=True)
+        write(get_landmarks_path(path), map, count, path)
@@ -30,26 +30,31 @@ try: map = sys.argv[1]
 except IndexError:
     map = "maps/hole.hex"
 
-# Create some important game managers.
+# Create some important game managers.  Messages are queued, so that orders
+# given while a frame is being drawn are handled at the start of the next step.
 world = tokens.World()
-messenger = engine.Messenger()
+messenger = engine.Messenger(queued=True)
 
 clock = pygame.time.Clock()
-loops = GameLoop(world, messenger), InterfaceLoop(world, messenger)
 
-# Load the game world.
-world.load(map)
+game = GameLoop(world, messenger)
+interface = InterfaceLoop(world, messenger)
+
+# The game runs in fixed steps, so that how fast the screen is drawn never
+# changes what happens in the game.
+scheduler = engine.Scheduler(game, interface, tick=25)
+interface.set_tick(scheduler.get_tick())
+
+# Load the game world, compiling the map the first time it's used.
+world.load(map, cache=True)
 
 # Setup the  loops.
-for loop in loops:
-    loop.setup()
+scheduler.setup()
 
 # Play the game!
 while True:
     time = clock.tick(40)
-    for loop in loops:
-        loop.update(time)
+    scheduler.update(time)
 
 # Close all the loops down.
-for loop in loops:
-    loop.teardown()
+scheduler.teardown()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+import os, sys
+import mmap
+import struct
+import ctypes
+
+# Compiled Maps {{{1
+# =============
+# Parsing a .hex file and building its tiles takes a while for large maps, so
+# maps can be compiled into a binary format that loads much faster.  The
+# compiled file is memory-mapped, and its arrays are handed to the compact
+# graph as they are, without being copied.  The mapping is copy-on-write, so
+# changing a tile never changes the file.
+#
+# Everything is little-endian.  The header is followed by these sections, in
+# order, each padded to a multiple of 8 bytes:
+#
+#   offsets     rows x uint8        1 if the row is offset, 0 otherwise.
+#   lengths     rows x uint32       The number of tiles in each row.
+#   types       tiles x char        'F' for clear tiles, ' ' for impassable.
+#   active      tiles x uint8
+#   weights     tiles x float64
+#   axial q     tiles x int32
+#   axial r     tiles x int32
+#
+# If the file has prebuilt adjacency, it also contains the arrays of a
+# graph.CompactGraph:
+#
+#   edges       (tiles + 1) x int64
+#   neighbors   edges x int32
+#   costs       edges x float64
+#
+# The header records the size and modification time of the .hex file that
+# was compiled, so a compiled file can tell when it's out of date.
+# }}}1
+
+magic = 'HEXM'
+version = 1
+extension = '.hexc'
+
+header = struct.Struct('<4sIIIIIiiQdI')
+adjacency = 0x1
+
+def get_compiled_path(path):
+    """ Returns the path where the given .hex file gets compiled to. """
+    return os.path.splitext(path)[0] + extension
+
+# Map File {{{1
+class MapFile:
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            try: self.buffer = mmap.mmap(
+                    file.fileno(), 0, access=mmap.ACCESS_COPY)
+            except ValueError:
+                raise MapFileError(path, "file is empty")
+
+        if len(self.buffer) < header.size:
+            raise MapFileError(path, "file is too short")
+
+        fields = header.unpack_from(self.buffer)
+
+        if fields[0] != magic:
+            raise MapFileError(path, "not a compiled map")
+        if fields[1] != version:
+            raise MapFileError(path, "version %d, expected %d" % (
+                fields[1], version))
+
+        (self.rows, self.columns, self.tiles, self.edges,
+                home_row, home_column,
+                self.source_size, self.source_mtime, self.flags) = fields[2:]
+
+        self.home = (home_row, home_column) if home_row >= 0 else None
+        self.position = padded(header.size)
+
+        self.offsets = self.read(ctypes.c_uint8, self.rows)
+        self.lengths = self.read(ctypes.c_uint32, self.rows)
+        self.types = self.read(ctypes.c_char, self.tiles)
+        self.active = self.read(ctypes.c_uint8, self.tiles)
+        self.weights = self.read(ctypes.c_double, self.tiles)
+        self.axial_q = self.read(ctypes.c_int32, self.tiles)
+        self.axial_r = self.read(ctypes.c_int32, self.tiles)
+
+        if self.has_adjacency():
+            self.edge_offsets = self.read(ctypes.c_int64, self.tiles + 1)
+            self.neighbors = self.read(ctypes.c_int32, self.edges)
+            self.costs = self.read(ctypes.c_double, self.edges)
+
+        if self.position > len(self.buffer):
+            raise MapFileError(path, "file is truncated")
+
+    def read(self, type, count):
+        """ Returns an array that views the next section of the file.  This
+        is a private method and should not be called outside this class. """
+
+        position = self.position
+        self.position += padded(ctypes.sizeof(type) * count)
+
+        if self.position > len(self.buffer):
+            return None
+
+        return (type * count).from_buffer(self.buffer, position)
+
+    # Attributes {{{2
+    def get_rows(self):
+        return self.rows
+    def get_columns(self):
+        return self.columns
+    def get_num_tiles(self):
+        return self.tiles
+    def get_num_edges(self):
+        return self.edges
+    def get_home(self):
+        return self.home
+
+    def get_offsets(self):
+        return [bool(offset) for offset in self.offsets]
+    def get_lengths(self):
+        return self.lengths
+
+    def get_lines(self):
+        """ Returns the types of the tiles in each row, as strings. """
+        lines = []
+        types = self.types.raw
+        start = 0
+
+        for length in self.lengths:
+            lines.append(types[start:start + length])
+            start += length
+
+        return lines
+
+    def get_active(self):
+        return self.active
+    def get_weights(self):
+        return self.weights
+    def get_axial(self):
+        return self.axial_q, self.axial_r
+
+    def has_adjacency(self):
+        return bool(self.flags & adjacency)
+    def get_adjacency(self):
+        return self.edge_offsets, self.neighbors, self.costs
+
+    def is_stale(self, source):
+        """ Returns true if the given .hex file has changed since it was
+        compiled into this file. """
+
+        try: status = os.stat(source)
+        except OSError: return False
+
+        return (status.st_size, status.st_mtime) != \
+                (self.source_size, self.source_mtime)
+    # }}}2
+
+# Writing {{{1
+def padded(size):
+    return size + (-size % 8)
+
+def write(path, map, source=None):
+    """ Compiles the given tokens.Map into the given path.  If a source path
+    is given, its size and modification time are recorded so that the
+    compiled file can later be checked against it.  The file is written
+    under a temporary name first, so a half-written file is never read. """
+
+    offsets = map.get_offsets()
+
+    home = map.get_home_tile()
+    home_row, home_column = home.get_position() if home else (-1, -1)
+
+    if source is not None:
+        status = os.stat(source)
+        source_size, source_mtime = status.st_size, status.st_mtime
+    else:
+        source_size, source_mtime = 0, 0
+
+    edge_offsets, neighbors, costs = map.get_adjacency()
+
+    active = map.get_active()
+    axial_q, axial_r = map.get_axial()
+
+    sections = [
+            ('B', offsets),
+            ('I', map.get_lengths()),
+            ('c', ['F' if flag else ' ' for flag in active]),
+            ('B', active),
+            ('d', map.get_weights()),
+            ('i', axial_q),
+            ('i', axial_r),
+            ('q', edge_offsets),
+            ('i', neighbors),
+            ('d', costs) ]
+
+    temporary = path + '.tmp'
+
+    with open(temporary, 'wb') as file:
+        file.write(header.pack(
+                magic, version, map.get_height(), map.get_width(),
+                map.get_num_nodes(), len(neighbors), home_row, home_column,
+                source_size, source_mtime, adjacency))
+        file.write('\0' * (padded(header.size) - header.size))
+
+        for code, values in sections:
+            data = struct.pack('<%d%s' % (len(values), code), *values)
+            file.write(data + '\0' * (padded(len(data)) - len(data)))
+
+    os.rename(temporary, path)
+
+def compile(source, path=None):
+    """ Compiles the given .hex file straight from the text, without ever
+    creating any tiles.  Only one row is held in memory at a time, so this
+    works for maps that are too big to load.  The compiled file has no
+    prebuilt adjacency.  The source is read once per section. """
+
+    import tokens
+
+    path = path or get_compiled_path(source)
+
+    offsets = []; lengths = []
+    home_row = home_column = -1
+
+    for row, (tiles, offset) in enumerate(tokens.read_rows(source)):
+        offsets.append(offset)
+        lengths.append(len(tiles))
+
+        # Like Map.make_nodes(), the last 'H' in the map is the home tile.
+        if 'H' in tiles:
+            home_row, home_column = row, tiles.rindex('H')
+
+    shifts = []; shift = 0
+    for offset in offsets:
+        shifts.append(shift)
+        if offset: shift += 1
+
+    # Each section is written one row at a time.  Axial coordinates are
+    # calculated the same way as in Map.make_nodes().
+    def types(row, tiles):
+        return ''.join(' ' if tile == ' ' else 'F' for tile in tiles)
+    def active(row, tiles):
+        return ''.join('\0' if tile == ' ' else '\1' for tile in tiles)
+    def weights(row, tiles):
+        return struct.pack('<%dd' % len(tiles), *[1] * len(tiles))
+    def axial_q(row, tiles):
+        shift = shifts[row]
+        return struct.pack('<%di' % len(tiles),
+                *range(-shift, len(tiles) - shift))
+    def axial_r(row, tiles):
+        return struct.pack('<%di' % len(tiles), *[row] * len(tiles))
+
+    status = os.stat(source)
+    temporary = path + '.tmp'
+
+    with open(temporary, 'wb') as file:
+        def pad(size):
+            file.write('\0' * (padded(size) - size))
+
+        file.write(header.pack(
+                magic, version, len(lengths), max(lengths or [0]),
+                sum(lengths), 0, home_row, home_column,
+                status.st_size, status.st_mtime, 0))
+        pad(header.size)
+
+        for code, values in ('B', offsets), ('I', lengths):
+            data = struct.pack('<%d%s' % (len(values), code), *values)
+            file.write(data); pad(len(data))
+
+        for section in types, active, weights, axial_q, axial_r:
+            size = 0
+            for row, (tiles, offset) in enumerate(tokens.read_rows(source)):
+                data = section(row, tiles)
+                file.write(data)
+                size += len(data)
+            pad(size)
+
+    os.rename(temporary, path)
+# }}}1
+
+# Map File Error {{{1
+class MapFileError(Exception):
+
+    def __init__(self, path, problem):
+        Exception.__init__(self, "%s: %s" % (path, problem))
+# }}}1
+
+if __name__ == "__main__":
+
+    import tokens
+
+    # Compile every map given on the command line.
+    for path in sys.argv[1:]:
+        map = tokens.Map()
+        map.load(path, compact=True)
+        write(get_compiled_path(path), map, path)
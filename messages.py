@@ -5,3 +5,16 @@ class MoveDot:
     def __init__(self, dots, target):
         self.dots = dots
         self.target = target
+
+    def get_claims(self):
+        return self.dots
+
+    def supersede(self, moved):
+        """ Returns this order without any of the given dots, which later
+        orders move, or None if it doesn't move any other dots. """
+
+        dots = [dot for dot in self.dots if dot not in moved]
+
+        if not dots: return None
+        if len(dots) == len(self.dots): return self
+        return MoveDot(dots, self.target)
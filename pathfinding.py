@@ -1,6 +1,12 @@
 import time
+import heapq
 import trees
 import graph
+import mapfile
+import landmarks
+
+import multiprocessing
+from multiprocessing import sharedctypes
 
 # Base Search Algorithm {{{1
 class SearchAlgorithm:
@@ -13,6 +19,7 @@ class SearchAlgorithm:
 
         self.found = False
         self.searching = False
+        self.expansions = 0
 
         self.start_time = 0
         self.search_time = 0
@@ -27,6 +34,8 @@ class SearchAlgorithm:
         return self.found
     def get_search_time(self):
         return self.search_time
+    def get_expansions(self):
+        return self.expansions
 
     def get_route(self):
         return self.route
@@ -37,8 +46,21 @@ class SearchAlgorithm:
     # Search Methods {{{2
     def search(self, source, target):
         self.searching = True
+        self.expansions = 0
         self.start_time = time.time()
 
+    # Searches that can be paused override start() and resume().  Every other
+    # search simply runs to completion as soon as it's started.
+
+    def start(self, source, target):
+        self.search(source, target)
+
+    def resume(self, expansions=None, deadline=None):
+        """ Continues a search started with start() until it either finishes,
+        expands the given number of nodes, or passes the given deadline (as
+        returned by time.time()).  Returns the number of nodes expanded. """
+        return 0
+
     def target_found(self, routes, source, target):
         tile = target
         route = [tile]
@@ -66,11 +88,14 @@ class SearchAlgorithm:
 
 # Depth First Search {{{1
 class DepthFirstSearch(SearchAlgorithm):
-    def search(self, map):
-        SearchAlgorithm.search(self, map)
 
-        source = map.get_source()
-        target = map.get_target()
+    def __init__(self, graph):
+        SearchAlgorithm.__init__(self)
+        self.graph = graph
+
+    def search(self, source, target):
+        SearchAlgorithm.search(self, source, target)
+        map = self.graph
 
         routes = dict()
         visited = set()
@@ -105,11 +130,14 @@ class DepthFirstSearch(SearchAlgorithm):
 
 # Breadth First Search {{{1
 class BreadthFirstSearch(SearchAlgorithm):
-    def search(self, map):
-        SearchAlgorithm.search(self, map)
 
-        source = map.get_source()
-        target = map.get_target()
+    def __init__(self, graph):
+        SearchAlgorithm.__init__(self)
+        self.graph = graph
+
+    def search(self, source, target):
+        SearchAlgorithm.search(self, source, target)
+        map = self.graph
 
         routes = {}
         visited = set([source])
@@ -145,29 +173,80 @@ class BreadthFirstSearch(SearchAlgorithm):
 # The Mighty A* {{{1
 class A_Star(SearchAlgorithm):
 
-    def __init__(self, graph):
+    # An epsilon greater than one inflates the heuristic, which makes the
+    # search expand far fewer nodes.  The route it finds is then only
+    # guaranteed to be within a factor of epsilon of the shortest one.
+
+    def __init__(self, graph, epsilon=1):
         SearchAlgorithm.__init__(self)
         self.graph = graph
+        self.epsilon = epsilon
+
+    def get_epsilon(self):
+        return self.epsilon
+    def set_epsilon(self, epsilon):
+        self.epsilon = epsilon
 
     def search(self, source, target):
+        self.start(source, target)
+        self.resume()
+
+    def start(self, source, target):
         SearchAlgorithm.search(self, source, target)
 
-        routes = {}
-        starting_nodes = { source : source }
+        self.source = source
+        self.target = target
 
-        real_costs = { source : 0 }
-        estimated_costs = { source : 0 }
+        self.visited = {}
+        self.starting_nodes = { source : source }
 
-        frontier_nodes = trees.IndexedPQ(estimated_costs)
-        frontier_nodes.push(source)
+        self.real_costs = { source : 0 }
+        self.estimated_costs = { source : 0 }
 
-        heuristic = self.graph.heuristic
+        self.frontier_nodes = trees.IndexedPQ(self.estimated_costs)
+        self.frontier_nodes.push(source)
+
+    def resume(self, expansions=None, deadline=None):
+        if not self.searching:
+            return 0
+
+        source = self.source
+        target = self.target
+
+        routes = self.visited
+        starting_nodes = self.starting_nodes
+
+        real_costs = self.real_costs
+        estimated_costs = self.estimated_costs
+        frontier_nodes = self.frontier_nodes
+
+        graph = self.graph
+        heuristic = graph.heuristic
+        epsilon = self.epsilon
+
+        # Tiles are views of their map's arrays, so on a map the costs and
+        # the heuristic are read from the arrays directly rather than through
+        # the edges and tiles.
+        arrays = hasattr(graph, 'get_weights')
+
+        if arrays:
+            weights = graph.get_weights()
+            active = graph.get_active()
+            index_heuristic = graph.index_heuristic
+            target_index = target.get_index()
+
+        count = 0
 
         # Loop through the graph.
         while not frontier_nodes.empty():
 
+            # Stop if this slice of the search is over.
+            if expansions is not None and count >= expansions: break
+            if deadline is not None and time.time() >= deadline: break
+
             closest_node = frontier_nodes.pop()
             routes[closest_node] = starting_nodes[closest_node]
+            count += 1
 
             # Check to see if the target was found.
             if closest_node == target:
@@ -175,38 +254,735 @@ class A_Star(SearchAlgorithm):
                 break
 
             # Add more edges to consider.
-            edges_from = self.graph.expand_node(closest_node)
+            edges_from = graph.expand_node(closest_node)
             if not edges_from:
-                edges_from = self.graph.get_edges_from(closest_node)
+                edges_from = graph.get_edges_from(closest_node)
 
             for edge in edges_from:
-                if not edge.is_active(): continue
-                if edge.get_end() in routes: continue
+                start = edge.start
+                end = edge.end
 
-                start = edge.get_start()
-                end = edge.get_end()
+                if end in routes: continue
+
+                if arrays:
+                    first = start.index; last = end.index
+                    if not active[first] or not active[last]: continue
+                    edge_cost = weights[first] * weights[last] * edge.distance
+                else:
+                    if not edge.is_active(): continue
+                    edge_cost = edge.get_cost()
+
+                real_cost = real_costs[start] + edge_cost
+                considering = end in frontier_nodes
+
+                # Already considering this node; choose the shortest path.
+                if considering and real_cost >= real_costs[end]: continue
+
+                if arrays:
+                    heuristic_cost = epsilon * index_heuristic(
+                            last, target_index)
+                else:
+                    heuristic_cost = epsilon * heuristic(end, target)
+
+                real_costs[end] = real_cost
+                estimated_costs[end] = real_cost + heuristic_cost
+                starting_nodes[end] = start
+
+                if considering: frontier_nodes.update(end)
+                else: frontier_nodes.push(end)
+        else:
+            self.target_not_found(routes)
+
+        self.expansions += count
+        return count
+
+# Bidirectional A* {{{1
+class BidirectionalA_Star(SearchAlgorithm):
+    """ Runs one A* search forward from the source and another backward from
+    the target, always expanding whichever frontier is smaller.  Every edge
+    that connects the two searches is a candidate route, and the search
+    stops once the cheapest frontier estimate in either direction can't beat
+    the best candidate.  With a consistent heuristic (like Map.heuristic)
+    that candidate is the shortest route.
+
+    The backward search follows the same edges as the forward one, which is
+    only correct because tokens.Map connects every pair of neighbors in both
+    directions with equal costs. """
+
+    def __init__(self, graph):
+        SearchAlgorithm.__init__(self)
+        self.graph = graph
+
+    def search(self, source, target):
+        SearchAlgorithm.search(self, source, target)
+
+        if source == target:
+            self.target_found({ source : source }, source, target)
+            return
+
+        forward = _Frontier(self.graph, source, target)
+        backward = _Frontier(self.graph, target, source)
+
+        best_cost = None
+        meeting_node = None
+
+        while not forward.empty() and not backward.empty():
+            if best_cost is not None:
+                if max(forward.peek_cost(), backward.peek_cost()) >= best_cost:
+                    break
+
+            if len(forward) <= len(backward):
+                this, other = forward, backward
+            else:
+                this, other = backward, forward
+
+            for node, cost in this.expand(other):
+                if best_cost is None or cost < best_cost:
+                    best_cost = cost
+                    meeting_node = node
+
+        if meeting_node is None:
+            self.target_not_found(forward.get_routes())
+            return
+
+        # The meeting node may still be in the forward frontier, so build the
+        # route from every parent the forward search has recorded.  Then
+        # splice the backward half of the route onto the forward half.
+        routes = dict(forward.get_parents())
+
+        node = meeting_node
+        next_nodes = backward.get_parents()
+
+        while node != target:
+            routes[next_nodes[node]] = node
+            node = next_nodes[node]
+
+        self.target_found(routes, source, target)
+
+class _Frontier:
+    """ One half of a bidirectional search.  This is a private class and
+    should not be used outside of this module. """
+
+    def __init__(self, graph, source, target):
+        self.graph = graph
+        self.target = target
+
+        self.routes = {}
+        self.parents = { source : source }
+
+        self.real_costs = { source : 0 }
+        self.estimated_costs = { source : graph.heuristic(source, target) }
+
+        self.frontier_nodes = trees.IndexedPQ(self.estimated_costs)
+        self.frontier_nodes.push(source)
+
+    def __len__(self):
+        return len(self.frontier_nodes)
+
+    def empty(self):
+        return self.frontier_nodes.empty()
+
+    def peek_cost(self):
+        return self.estimated_costs[self.frontier_nodes.peek()]
+
+    def get_routes(self):
+        return self.routes
+    def get_parents(self):
+        return self.parents
+    def get_real_cost(self, node):
+        return self.real_costs.get(node)
+
+    def expand(self, other):
+        """ Expands the closest node in the frontier and returns the cost of
+        every route that now connects to the other search. """
+
+        graph = self.graph
+        target = self.target
+        routes = self.routes
+        parents = self.parents
+        real_costs = self.real_costs
+        estimated_costs = self.estimated_costs
+        frontier_nodes = self.frontier_nodes
+
+        closest_node = frontier_nodes.pop()
+        routes[closest_node] = parents[closest_node]
+
+        meetings = []
+
+        edges_from = graph.expand_node(closest_node)
+        if not edges_from:
+            edges_from = graph.get_edges_from(closest_node)
+
+        for edge in edges_from:
+            if not edge.is_active(): continue
+            if edge.get_end() in routes: continue
+
+            end = edge.get_end()
+            real_cost = real_costs[closest_node] + edge.get_cost()
+
+            if end in frontier_nodes:
+                if real_cost < real_costs[end]:
+                    real_costs[end] = real_cost
+                    estimated_costs[end] = \
+                            real_cost + graph.heuristic(end, target)
+
+                    parents[end] = closest_node
+                    frontier_nodes.update(end)
+            else:
+                real_costs[end] = real_cost
+                estimated_costs[end] = real_cost + graph.heuristic(end, target)
 
-                real_cost = real_costs[start] + edge.get_cost()
-                heuristic_cost = heuristic(end, target)
+                parents[end] = closest_node
+                frontier_nodes.push(end)
+
+            other_cost = other.get_real_cost(end)
+            if other_cost is not None:
+                meetings.append((end, real_costs[end] + other_cost))
+
+        return meetings
+
+# Jump Point Search {{{1
+class JumpPointSearch(SearchAlgorithm):
+    """ Symmetry-breaking search for maps where every step costs the same.
+
+    On a uniform hex grid, a shortest route between two tiles is made of
+    steps in at most two neighboring directions, and there are usually a
+    huge number of equivalent ways to order them.  This search only
+    considers one: all the steps in one direction (the primary leg) followed
+    by all the steps in the direction 60 degrees counterclockwise of it (the
+    secondary leg).  Legs are followed without touching the open list, and
+    only stop at jump points:
+
+    1. The target.
+
+    2. Tiles with a forced neighbor, i.e. a neighbor that can't be reached
+       as cheaply without going through the tile, because an obstacle or the
+       edge of the map blocks the other way around.
+
+    3. Tiles on a primary leg whose secondary leg finds a jump point.
+
+    Jump points continue their natural legs, and start new legs towards any
+    forced neighbors.  Maps with more than one tile weight are handed off to
+    A_Star. """
+
+    # Axial directions, in counterclockwise order.
+    directions = [(1, 0), (1, -1), (0, -1), (-1, 0), (-1, 1), (0, 1)]
+
+    def __init__(self, graph):
+        SearchAlgorithm.__init__(self)
+        self.graph = graph
+        self.fallback = A_Star(graph)
+
+    def search(self, source, target):
+        if not self.graph.is_uniform():
+            self.fallback_search(source, target)
+            return
+
+        SearchAlgorithm.search(self, source, target)
+
+        heuristic = self.graph.heuristic
+        step_cost = self.graph.get_min_cost()
+
+        # Each jump point is recorded with the jump point it was reached from
+        # and the direction and length of the jump, so the whole route can be
+        # rebuilt afterwards.  The leg it was reached on decides which
+        # directions it will be expanded in.
+        jumps = { source : (source, 0, 0) }
+        arrivals = { source : None }
+
+        real_costs = { source : 0 }
+        estimated_costs = { source : heuristic(source, target) }
+
+        frontier_nodes = trees.IndexedPQ(estimated_costs)
+        frontier_nodes.push(source)
+
+        closed = set()
+
+        while not frontier_nodes.empty():
+            closest_node = frontier_nodes.pop()
+            closed.add(closest_node)
+
+            if closest_node == target:
+                routes = self.unroll(jumps, source, target)
+                self.target_found(routes, source, target)
+                break
+
+            legs = self.get_legs(closest_node, arrivals[closest_node])
+
+            for direction, primary in legs:
+                jump = self.jump(closest_node, direction, primary, target)
+                if not jump: continue
+
+                end, steps, arrival = jump
+                if end in closed: continue
+
+                real_cost = real_costs[closest_node] + steps * step_cost
 
                 if end in frontier_nodes:
-                    # Already considering this node; choose the shortest path.
                     if real_cost < real_costs[end]:
                         real_costs[end] = real_cost
-                        estimated_costs[end] = real_cost + heuristic_cost
+                        estimated_costs[end] = \
+                                real_cost + heuristic(end, target)
 
-                        starting_nodes[end] = start
+                        jumps[end] = (closest_node, direction, steps)
+                        arrivals[end] = arrival
                         frontier_nodes.update(end)
                 else:
-                    # Haven't been here before; store the edge.
                     real_costs[end] = real_cost
-                    estimated_costs[end] = real_cost + heuristic_cost
+                    estimated_costs[end] = real_cost + heuristic(end, target)
 
-                    starting_nodes[end] = start
+                    jumps[end] = (closest_node, direction, steps)
+                    arrivals[end] = arrival
                     frontier_nodes.push(end)
+        else:
+            self.target_not_found({})
+
+    def fallback_search(self, source, target):
+        fallback = self.fallback
+        fallback.search(source, target)
+
+        self.route = fallback.get_route()
+        self.routes = fallback.get_routes()
+
+        self.found = fallback.was_target_found()
+        self.searching = False
+        self.search_time = fallback.get_search_time()
+
+    def jump(self, tile, direction, primary, target):
+        """ Follows a leg in the given direction, starting at the given tile.
+        Returns the jump point that was found, its distance in steps and the
+        leg it was reached on, or None if the leg was blocked first. """
+
+        dq, dr = self.directions[direction]
+        q, r = tile.get_axial()
+        steps = 0
+
+        while True:
+            q += dq; r += dr; steps += 1
+
+            tile = self.step(q, r)
+            if tile is None:
+                return None
+
+            arrival = direction, primary
+
+            if tile == target or self.get_forced(tile, arrival):
+                return tile, steps, arrival
+
+            if primary:
+                secondary = (direction + 1) % 6
+                if self.jump(tile, secondary, False, target):
+                    return tile, steps, arrival
+
+    def get_legs(self, tile, arrival):
+        """ Returns the legs that should be followed out of the given jump
+        point, as (direction, primary) pairs. """
+
+        if arrival is None:
+            return [(direction, True) for direction in range(6)]
+
+        direction, primary = arrival
+        forced = self.get_forced(tile, arrival)
+
+        if primary:
+            legs = [(direction, True), ((direction + 1) % 6, False)]
+        else:
+            legs = [(direction, False)]
+
+        # Routes through a forced neighbor mix its direction with the one the
+        # jump point was reached in, so whichever of the two comes first in
+        # counterclockwise order has to start a primary leg.
+        for neighbor in forced:
+            if neighbor == (direction - 1) % 6:
+                legs.append((neighbor, True))
+            else:
+                legs.append((neighbor, False))
+                legs[0] = (direction, True)
+
+        return legs
+
+    def get_forced(self, tile, arrival):
+        """ Returns the directions of any forced neighbors of the given tile.
+        A neighbor is forced if it's open, but the tile next to it that the
+        canonical route would have come through is blocked. """
+
+        direction, primary = arrival
+
+        q, r = tile.get_axial()
+        dq, dr = self.directions[direction]
+
+        if primary:
+            candidates = (direction - 1) % 6,
+        else:
+            candidates = (direction - 1) % 6, (direction + 1) % 6
+
+        forced = []
+
+        for neighbor in candidates:
+            nq, nr = self.directions[neighbor]
+
+            if self.step(q - dq + nq, r - dr + nr) is not None: continue
+            if self.step(q + nq, r + nr) is None: continue
+
+            forced.append(neighbor)
+
+        return forced
+
+    def step(self, q, r):
+        tile = self.graph.get_axial_tile(q, r)
+        if tile is None or not tile.is_active():
+            return None
+        return tile
+
+    def unroll(self, jumps, source, target):
+        """ Fills in every tile between consecutive jump points, and returns
+        the result in the form expected by target_found(). """
+
+        routes = {}
+        end = target
+
+        while end != source:
+            start, direction, steps = jumps[end]
+
+            dq, dr = self.directions[direction]
+            q, r = start.get_axial()
+            previous = start
+
+            for step in range(steps):
+                q += dq; r += dr
+                next = self.graph.get_axial_tile(q, r)
+
+                routes[next] = previous
+                previous = next
+
+            end = start
+
+        return routes
+
+# Array A* {{{1
+def expand_arrays(offsets, neighbors, costs, active, heuristic, target,
+                  parents, real_costs, closed, frontier, epsilon=1,
+                  expansions=None, deadline=None):
+    """ Runs A* toward the given target on the integer indices and adjacency
+    arrays of a compact graph, where heuristic(index, target) estimates the
+    cost between two indices.  The search state is kept in the given parents,
+    real_costs, closed and frontier, so a search that stops early can be
+    picked up again by passing them back in.  Returns the number of nodes
+    expanded, and whether the search finished. """
+
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+
+    count = 0
+
+    while frontier:
+        if expansions is not None and count >= expansions or \
+                deadline is not None and time.time() >= deadline:
+            return count, False
+
+        estimate, index = heappop(frontier)
+
+        # Stale entries are left in the heap when a cheaper route to a
+        # node is found, so skip anything that's already been expanded.
+        if index in closed: continue
+        closed.add(index)
+        count += 1
+
+        if index == target:
+            break
+
+        # Edges are only active if both of their nodes are.
+        if not active[index]: continue
+
+        real_cost = real_costs[index]
+
+        for position in range(offsets[index], offsets[index + 1]):
+            neighbor = neighbors[position]
+
+            if not active[neighbor]: continue
+            if neighbor in closed: continue
+
+            cost = real_cost + costs[position]
+
+            if neighbor not in real_costs or cost < real_costs[neighbor]:
+                real_costs[neighbor] = cost
+                parents[neighbor] = index
+
+                estimate = cost + epsilon * heuristic(neighbor, target)
+                heappush(frontier, (estimate, neighbor))
+
+    return count, True
+
+# Compact A* {{{1
+class CompactA_Star(SearchAlgorithm):
+    """ A* search that runs directly on the integer indices and arrays of a
+    compact map (see tokens.Map.load), without touching any Tile or Edge
+    objects until the route is handed back.  It takes and returns the same
+    things as A_Star, so the two can be swapped freely. """
+
+    def __init__(self, graph, epsilon=1):
+        SearchAlgorithm.__init__(self)
+        self.graph = graph
+        self.epsilon = epsilon
+
+    def get_epsilon(self):
+        return self.epsilon
+    def set_epsilon(self, epsilon):
+        self.epsilon = epsilon
+
+    def search(self, source, target):
+        self.start(source, target)
+        self.resume()
+
+    def start(self, source, target):
+        SearchAlgorithm.search(self, source, target)
+
+        self.source = source
+        self.target = target
+
+        source_index = source.get_index()
+
+        self.parents = { source_index : source_index }
+        self.real_costs = { source_index : 0 }
+        self.closed = set()
+        self.frontier = [(0, source_index)]
+
+    def resume(self, expansions=None, deadline=None):
+        if not self.searching:
+            return 0
+
+        compact = self.graph.get_compact()
+        offsets, neighbors, costs, active = compact.get_arrays()
+
+        source = self.source
+        target = self.target
+        target_index = target.get_index()
+
+        parents = self.parents
+        closed = self.closed
+
+        count, finished = expand_arrays(
+                offsets, neighbors, costs, active,
+                self.graph.index_heuristic, target_index,
+                parents, self.real_costs, closed, self.frontier,
+                self.epsilon, expansions, deadline)
+
+        self.expansions += count
+
+        if not finished:
+            return count
+
+        nodes = compact.get_nodes()
+        routes = dict((nodes[index], nodes[parents[index]])
+                      for index in closed)
+
+        if target_index in closed:
+            self.target_found(routes, source, target)
         else:
             self.target_not_found(routes)
 
+        return count
+
+# D* Lite {{{1
+class DStarLite(SearchAlgorithm):
+    """ Incremental planner that keeps its search state between calls, so that
+    a route can be repaired cheaply when the map changes underneath it.
+
+    The search runs backward from the target, keeping for every node its
+    cost-to-target (g) and a one-step lookahead of that cost (rhs).  The
+    planner listens to the graph, and when a node changes only the costs of
+    that node and its neighbors are recalculated.  Inconsistencies are then
+    propagated until the route from the current source is settled again,
+    which for a change near the target is a small amount of work no matter
+    how long the route is.  Calling search() again with the same target
+    reuses everything; a new target starts over.
+
+    The planner has to be detached when it's no longer needed, or the graph
+    will keep telling it about changes. """
+
+    infinity = float('inf')
+
+    def __init__(self, graph):
+        SearchAlgorithm.__init__(self)
+        self.graph = graph
+
+        self.target = None
+        self.changes = set()
+
+        graph.add_listener(self)
+
+    def detach(self):
+        self.graph.remove_listener(self)
+
+    def get_target(self):
+        return self.target
+    def has_changes(self):
+        return bool(self.changes)
+
+    def node_changed(self, node):
+        if self.target is not None:
+            self.changes.add(node)
+
+    def search(self, source, target):
+        SearchAlgorithm.search(self, source, target)
+
+        # The keys already in the queue are only valid for the heuristic
+        # they were calculated with, so start over if that has changed.
+        graph = self.graph
+        restart = target != self.target or \
+                graph.get_min_cost() != self.min_cost or \
+                graph.get_heuristic_version() != self.heuristic_version
+
+        if restart:
+            self.initialize(source, target)
+        else:
+            self.key_modifier += self.graph.heuristic(self.last, source)
+            self.source = self.last = source
+
+            self.apply_changes()
+
+        self.compute_shortest_path()
+
+        if self.rhs(source) == self.infinity:
+            self.target_not_found({})
+        else:
+            self.target_found(self.follow_route(), source, target)
+
+    def initialize(self, source, target):
+        self.source = self.last = source
+        self.target = target
+        self.min_cost = self.graph.get_min_cost()
+        self.heuristic_version = self.graph.get_heuristic_version()
+
+        self.g_values = {}
+        self.rhs_values = { target : 0 }
+        self.key_modifier = 0
+        self.changes = set()
+
+        self.keys = { target : self.calculate_key(target) }
+        self.queue = trees.IndexedPQ(self.keys)
+        self.queue.push(target)
+
+    def apply_changes(self):
+        """ Recalculates the lookahead cost of every node that has an edge
+        whose cost may have changed, i.e. every changed node and all of its
+        neighbors. """
+
+        affected = set()
+
+        for node in self.changes:
+            affected.add(node)
+            affected.update(edge.get_end() for edge in self.get_edges(node))
+
+        for node in affected:
+            if node != self.target:
+                self.rhs_values[node] = self.lookahead(node)
+            self.update_node(node)
+
+        self.changes = set()
+
+    def compute_shortest_path(self):
+        queue = self.queue
+        keys = self.keys
+        source = self.source
+
+        while not queue.empty():
+            node = queue.peek()
+            old_key = keys[node]
+
+            if old_key >= self.calculate_key(source) and \
+                    self.rhs(source) <= self.g(source):
+                break
+
+            new_key = self.calculate_key(node)
+            g = self.g(node); rhs = self.rhs(node)
+
+            if old_key < new_key:
+                keys[node] = new_key
+                queue.update(node)
+
+            elif g > rhs:
+                self.g_values[node] = rhs
+                queue.remove(node)
+
+                for edge in self.get_edges(node):
+                    neighbor = edge.get_end()
+                    if neighbor == self.target: continue
+
+                    cost = self.get_cost(edge) + rhs
+                    if cost < self.rhs(neighbor):
+                        self.rhs_values[neighbor] = cost
+                        self.update_node(neighbor)
+
+            else:
+                self.g_values[node] = self.infinity
+                neighbors = [edge.get_end() for edge in self.get_edges(node)]
+
+                for neighbor in neighbors + [node]:
+                    if neighbor != self.target:
+                        self.rhs_values[neighbor] = self.lookahead(neighbor)
+                    self.update_node(neighbor)
+
+    def follow_route(self):
+        """ Walks downhill from the source to the target, and returns the
+        route in the form expected by target_found(). """
+
+        routes = {}
+        node = self.source
+
+        for step in range(self.graph.get_num_nodes()):
+            if node == self.target:
+                break
+
+            best_node, best_cost = None, self.infinity
+
+            for edge in self.get_edges(node):
+                cost = self.get_cost(edge) + self.g(edge.get_end())
+                if cost < best_cost:
+                    best_node, best_cost = edge.get_end(), cost
+
+            routes[best_node] = node
+            node = best_node
+
+        return routes
+
+    def update_node(self, node):
+        queue = self.queue
+        consistent = self.g(node) == self.rhs(node)
+
+        if not consistent:
+            self.keys[node] = self.calculate_key(node)
+            if node in queue: queue.update(node)
+            else: queue.push(node)
+
+        elif node in queue:
+            queue.remove(node)
+
+    def calculate_key(self, node):
+        cost = min(self.g(node), self.rhs(node))
+        heuristic = self.graph.heuristic(self.source, node)
+        return (cost + heuristic + self.key_modifier, cost)
+
+    def lookahead(self, node):
+        costs = [self.get_cost(edge) + self.g(edge.get_end())
+                 for edge in self.get_edges(node)]
+        return min(costs) if costs else self.infinity
+
+    def g(self, node):
+        return self.g_values.get(node, self.infinity)
+    def rhs(self, node):
+        return self.rhs_values.get(node, self.infinity)
+
+    def get_edges(self, node):
+        edges_from = self.graph.expand_node(node)
+        if not edges_from:
+            edges_from = self.graph.get_edges_from(node)
+        return edges_from
+
+    def get_cost(self, edge):
+        if not edge.is_active(): return self.infinity
+        return edge.get_cost()
+
 # Dijkstra's Algorithm {{{1
 class Dijkstra(A_Star):
     def __init__(self):
@@ -214,4 +990,390 @@ class Dijkstra(A_Star):
 
     def __heuristic(self, start, end):
         return 0
+
+# Generation Cache {{{1
+class GenerationCache:
+    """ A least recently used cache that's emptied whenever the generation of
+    its graph changes.  Subclasses decide what's kept in it, and should call
+    check_generation() before touching the cache. """
+
+    def __init__(self, graph, capacity):
+        self.graph = graph
+        self.cache = trees.LRUCache(capacity)
+
+        self.generation = graph.get_generation()
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def check_generation(self):
+        generation = self.graph.get_generation()
+
+        if generation != self.generation:
+            self.cache.clear()
+            self.generation = generation
+            self.invalidations += 1
+
+    def get_capacity(self):
+        return self.cache.get_capacity()
+    def get_hits(self):
+        return self.cache.get_hits()
+    def get_misses(self):
+        return self.cache.get_misses()
+    def get_evictions(self):
+        return self.cache.get_evictions()
+    def get_invalidations(self):
+        return self.invalidations
+
+    def set_capacity(self, capacity):
+        self.cache.set_capacity(capacity)
+
+# Route Cache {{{1
+class RouteCache(GenerationCache):
+    """ Remembers recently found routes, keyed by their source and target.
+    The whole cache is thrown out whenever the graph's generation changes,
+    since any activated, deactivated or reweighted node could change the best
+    route.  Routes are copied going in and coming out, because dots consume
+    their routes as they move. """
+
+    def __init__(self, graph, capacity=256):
+        GenerationCache.__init__(self, graph, capacity)
+
+    def lookup(self, source, target):
+        self.check_generation()
+        route = self.cache.get((source, target))
+        return list(route) if route is not None else None
+
+    def store(self, source, target, route):
+        self.check_generation()
+        self.cache.put((source, target), list(route))
+
+# Flow Field {{{1
+class FlowField:
+    """ Points every node that can reach the target towards the next node on
+    its shortest route there.  Building the field costs one Dijkstra search
+    outwards from the target, after which the route from any node can be
+    read off in time proportional to its length.  This relies on every edge
+    having a twin going the other way with the same cost, which is how
+    tokens.Map builds its edges.
+
+    Like the searches, a field can be built a little bit at a time with
+    resume().  Routes can't be read from it until it's finished. """
+
+    def __init__(self, graph, target, build=True):
+        self.graph = graph
+        self.target = target
+
+        self.generation = graph.get_generation()
+        self.start()
+
+        if build: self.resume()
+
+    def start(self):
+        target = self.target
+
+        self.pointers = { target : target }
+        self.costs = { target : 0 }
+        self.closed = set()
+
+        self.frontier_nodes = trees.IndexedPQ(self.costs)
+        self.frontier_nodes.push(target)
+
+        self.searching = True
+        self.expansions = 0
+
+    def build(self):
+        self.start()
+        self.resume()
+
+    def resume(self, expansions=None, deadline=None):
+        """ Continues building the field until it's finished, the given
+        number of nodes have been expanded, or the given deadline passes.
+        Returns the number of nodes expanded. """
+
+        if not self.searching:
+            return 0
+
+        pointers = self.pointers
+        costs = self.costs
+        closed = self.closed
+        frontier_nodes = self.frontier_nodes
+
+        count = 0
+
+        while not frontier_nodes.empty():
+            if expansions is not None and count >= expansions: break
+            if deadline is not None and time.time() >= deadline: break
+
+            closest_node = frontier_nodes.pop()
+            closed.add(closest_node)
+            count += 1
+
+            edges_from = self.graph.expand_node(closest_node)
+            if not edges_from:
+                edges_from = self.graph.get_edges_from(closest_node)
+
+            for edge in edges_from:
+                if not edge.is_active(): continue
+                if edge.get_end() in closed: continue
+
+                end = edge.get_end()
+                cost = costs[closest_node] + edge.get_cost()
+
+                if end in frontier_nodes:
+                    if cost < costs[end]:
+                        costs[end] = cost
+                        pointers[end] = closest_node
+                        frontier_nodes.update(end)
+                else:
+                    costs[end] = cost
+                    pointers[end] = closest_node
+                    frontier_nodes.push(end)
+        else:
+            # Only the pointers are needed once the field is finished.
+            self.searching = False
+            self.costs = self.closed = self.frontier_nodes = None
+
+        self.expansions += count
+        return count
+
+    def get_target(self):
+        return self.target
+    def get_generation(self):
+        return self.generation
+    def get_expansions(self):
+        return self.expansions
+    def is_searching(self):
+        return self.searching
+
+    def is_reachable(self, source):
+        return source in self.pointers
+
+    def get_route(self, source):
+        """ Returns the route from the given source in the same order as
+        SearchAlgorithm.get_route(), i.e. starting with the target.  The route
+        is empty if the target can't be reached. """
+
+        pointers = self.pointers
+        if source not in pointers:
+            return []
+
+        tile = source
+        route = [tile]
+
+        while tile != self.target:
+            tile = pointers[tile]
+            route.append(tile)
+
+        route.reverse()
+        return route
+
+# Flow Field Cache {{{1
+class FlowFieldCache(GenerationCache):
+    """ Keeps the flow fields for the most recently used targets, and throws
+    them all out whenever the graph's generation changes. """
+
+    def __init__(self, graph, capacity=16):
+        GenerationCache.__init__(self, graph, capacity)
+
+    def lookup(self, target, build=True):
+        """ Returns the field for the given target.  If build is false, a new
+        field is only started, and it's up to the caller to finish it with
+        resume().  Otherwise the field is always finished. """
+
+        self.check_generation()
+
+        field = self.cache.get(target)
+        if field is None:
+            field = FlowField(self.graph, target, build)
+            self.cache.put(target, field)
+
+        elif build and field.is_searching():
+            field.resume()
+
+        return field
+
+# Batch Search {{{1
+class BatchSearch:
+    """ Answers many route queries at once by spreading them over a pool of
+    worker processes.  The map's adjacency, weights, activity and axial
+    coordinates are copied once into shared memory when the pool is created,
+    and the workers search those arrays directly, so the map itself is never
+    pickled.  The search is the same as CompactA_Star's, so the routes are
+    identical to the ones it finds and cost the same as A_Star's.  If the
+    map has landmarks, each worker maps the same landmark file and uses the
+    same heuristic as the map, for as long as the tables stay valid.
+
+    The batch listens to the map, and copies any changed tile into the
+    shared arrays, which the workers see right away.  It should be closed
+    once it's no longer needed, to stop the workers. """
+
+    def __init__(self, map, processes=None, epsilon=1):
+        self.map = map
+        self.epsilon = epsilon
+        self.processes = processes or multiprocessing.cpu_count()
+
+        self.publish()
+
+        self.pool = multiprocessing.Pool(
+                self.processes, _attach_worker, (self.arrays, epsilon))
+
+        map.add_listener(self)
+
+    def publish(self):
+        """ Copies the map into shared memory.  Maps that aren't compact are
+        converted on the way.  This is a private method and should not be
+        called outside this class. """
+
+        map = self.map
+
+        offsets, neighbors, costs = map.get_adjacency()
+        axial_q, axial_r = map.get_axial()
+
+        def share(code, values):
+            shared = sharedctypes.RawArray(code, len(values))
+            shared[:] = values
+            return shared
+
+        self.arrays = {
+                'offsets' : share('l', offsets),
+                'neighbors' : share('i', neighbors),
+                'costs' : share('d', costs),
+                'weights' : share('d', map.get_weights()),
+                'active' : share('B', map.get_active()),
+                'axial_q' : share('l', axial_q),
+                'axial_r' : share('l', axial_r),
+                'min_cost' : sharedctypes.RawValue('d', map.get_min_cost()),
+                'landmarks' : None,
+                'landmarks_valid' : sharedctypes.RawValue('B', 0) }
+
+        # The workers open the landmark file themselves.  Whether they can
+        # use it is decided here, since only this process sees the changes.
+        self.landmarks = map.get_landmarks()
+
+        if self.landmarks and self.landmarks.check(map):
+            self.arrays['landmarks'] = self.landmarks.get_path()
+            self.arrays['landmarks_valid'].value = 1
+
+        # A compact graph over the shared arrays keeps the costs up to date
+        # when tiles change.  The tiles are only needed to build routes.
+        self.graph = graph.CompactGraph(
+                map.get_nodes(), self.arrays['offsets'],
+                self.arrays['neighbors'], self.arrays['weights'],
+                self.arrays['active'], self.arrays['costs'])
+
+        self.measured = True
+
+    def close(self):
+        self.map.remove_listener(self)
+        self.pool.close()
+        self.pool.join()
+
+    def get_processes(self):
+        return self.processes
+    def get_epsilon(self):
+        return self.epsilon
+
+    def node_changed(self, tile):
+        index = tile.get_index()
+        self.graph.set_weight(index, tile.get_weight())
+        self.graph.set_active(index, tile.is_active())
+
+        # The heuristic is only remeasured before the next batch.
+        self.measured = False
+
+    def search(self, pairs):
+        """ Finds a route for each (source, target) pair.  Every route is a
+        list of tiles from the target back to the source, like the routes
+        returned by A_Star.get_route(), and is empty if there's no route. """
+
+        if not self.measured:
+            tables = self.map.get_landmarks()
+            valid = tables is not None and tables is self.landmarks and \
+                    tables.is_valid()
+
+            self.arrays['min_cost'].value = self.map.get_min_cost()
+            self.arrays['landmarks_valid'].value = valid
+            self.measured = True
+
+        queries = [(source.get_index(), target.get_index())
+                   for source, target in pairs]
+
+        # Bigger chunks mean less talking to the workers, but every worker
+        # should still get a few chunks to even out the load.
+        chunk = max(1, len(queries) // (4 * self.processes))
+        results = self.pool.map(_find_route, queries, chunk)
+
+        get_node = self.map.get_node
+        return [[get_node(index) for index in route] for route in results]
+
+# The arrays and epsilon of the batch that created this worker, and its view
+# of the landmark file if there is one.  These are only set inside worker
+# processes.
+_shared = None
+_tables = None
+
+def _attach_worker(arrays, epsilon):
+    global _shared, _tables
+    _shared = arrays, epsilon
+    _tables = None
+
+    if arrays['landmarks']:
+        try: _tables = landmarks.LandmarkFile(arrays['landmarks'])
+        except (IOError, mapfile.MapFileError): pass
+
+def _find_route(query):
+    """ Runs the same search as CompactA_Star on the shared arrays, with the
+    same heuristic as tokens.Map.index_heuristic(), and returns the indices
+    along the route from the target back to the source, or an empty list if
+    there isn't one. """
+
+    arrays, epsilon = _shared
+    source, target = query
+
+    offsets = arrays['offsets']
+    neighbors = arrays['neighbors']
+    costs = arrays['costs']
+    active = arrays['active']
+
+    q = arrays['axial_q']; r = arrays['axial_r']
+    min_cost = arrays['min_cost'].value
+    target_q = q[target]; target_r = r[target]
+
+    # The landmark bound, if the tables are still valid.
+    count = 0
+
+    if _tables is not None and arrays['landmarks_valid'].value:
+        count = _tables.get_count()
+        distances = _tables.get_distances()
+        target_row = distances[target * count:(target + 1) * count]
+
+    def heuristic(index, target):
+        dq = q[index] - target_q; dr = r[index] - target_r
+        estimate = (abs(dq) + abs(dr) + abs(dq + dr)) // 2 * min_cost
+
+        if count:
+            bound = landmarks.get_bound(distances, count, index, target_row)
+            if bound > estimate: estimate = bound
+
+        return estimate
+
+    parents = { source : source }
+    closed = set()
+
+    expand_arrays(offsets, neighbors, costs, active, heuristic, target,
+                  parents, { source : 0 }, closed, [(0, source)], epsilon)
+
+    if target not in closed:
+        return []
+
+    index = target
+    route = [index]
+
+    while index != source:
+        index = parents[index]
+        route.append(index)
+
+    return route
 # }}}1
@@ -1,97 +1,473 @@
+import os
 import graph
+import trees
+import mapfile
+import landmarks
+
+from array import array
+from bisect import bisect_right
 
 # World {{{1
 class World:
 
     def __init__(self):
         self.map = Map()
-        self.dots = [Dot(self.map)]
+        self.occupancy = Occupancy()
+        self.store = DotStore(self.map, self)
 
-    def load(self, path):
-        self.map.load(path)
+        self.add_dot(Dot(self.map))
+
+    def load(self, path, compact=False, cache=False, implicit=False):
+        self.map.load(path, compact, cache, implicit)
 
         home = self.map.get_home_tile()
-        self.dots[0].load(home)
+        self.get_dots()[0].load(home)
+
+        # Index every dot in the store again, not just the one that was
+        # moved home, so that none of them go missing from the occupancy.
+        store = self.store
+        self.occupancy.clear()
+
+        for dot, index in zip(store.get_dots(), store.positions):
+            self.occupancy.add_index(dot, index)
+
+    def update(self, time):
+        """ Advances every dot along its route. """
+        self.store.step(time)
 
     def get_map(self):
         return self.map
 
+    def get_dots(self):
+        return self.store.get_dots()
+    def get_planned_dots(self):
+        return self.store.get_planned_dots()
+    def get_store(self):
+        return self.store
+    def get_occupancy(self):
+        return self.occupancy
+
+    def add_dot(self, dot):
+        """ Adds a dot to the world.  Dots should always be added this way,
+        rather than by appending to get_dots(), so that they're stored with
+        the rest of the world's dots and can be found by position. """
+
+        self.store.adopt(dot)
+        self.occupancy.add(dot, dot.get_position())
+
+    def remove_dot(self, dot):
+        self.occupancy.remove(dot, dot.get_position())
+        self.store.remove(dot)
+
+    def dot_moved(self, dot, previous):
+        self.occupancy.move(dot, previous, dot.get_position())
+
+    # Dot Queries {{{2
+    def get_dots_on(self, tile):
+        return self.occupancy.get_dots(tile.get_index())
+
+    def get_dots_near(self, tile, radius):
+        """ Returns every dot within the given number of steps of the given
+        tile.  Either the tiles in range or the occupied tiles are checked,
+        whichever there are fewer of. """
+
+        occupancy = self.occupancy
+        map = self.map
+
+        if len(occupancy) < 3 * radius * (radius + 1) + 1:
+            q, r = map.get_axial()
+            center = tile.get_index()
+
+            def in_range(index):
+                dq = q[index] - q[center]; dr = r[index] - r[center]
+                return abs(dq) + abs(dr) + abs(dq + dr) <= 2 * radius
+
+            indices = [index for index in occupancy.get_indices()
+                       if in_range(index)]
+        else:
+            indices = map.get_hexagon(tile, radius)
+
+        return occupancy.get_dots_in(indices)
+
+    def get_dots_in(self, indices):
+        return self.occupancy.get_dots_in(indices)
+    # }}}2
+
+# Occupancy {{{1
+class Occupancy:
+    """ Keeps track of which dots are on which tiles, by tile index.  Tiles
+    with no dots on them aren't stored at all. """
+
+    def __init__(self):
+        self.dots = {}
+
+    def __len__(self):
+        """ Returns the number of occupied tiles. """
+        return len(self.dots)
+
+    def clear(self):
+        self.dots = {}
+
+    def add(self, dot, tile):
+        if tile is None: return
+        self.add_index(dot, tile.get_index())
+
+    def remove(self, dot, tile):
+        if tile is None: return
+        self.remove_index(dot, tile.get_index())
+
+    def move(self, dot, previous, tile):
+        self.remove(dot, previous)
+        self.add(dot, tile)
+
+    # The same as above, but with tile indices rather than tiles.  Negative
+    # indices mean that the dot isn't on any tile.
+
+    def add_index(self, dot, index):
+        if index < 0: return
+        self.dots.setdefault(index, []).append(dot)
+
+    def remove_index(self, dot, index):
+        dots = self.dots.get(index)
+        if not dots or dot not in dots: return
+
+        dots.remove(dot)
+        if not dots: del self.dots[index]
+
+    def get_indices(self):
+        return self.dots.keys()
+
+    def get_dots(self, index):
+        return list(self.dots.get(index, []))
+
+    def get_dots_in(self, indices):
+        dots = self.dots
+        return [dot for index in indices if index in dots
+                for dot in dots[index]]
+
+# Dot Store {{{1
+class DotStore:
+    """ The state of a group of dots, kept in parallel arrays so that every
+    dot can be advanced in a single step.  Dot objects are just views of one
+    entry in a store, in the same way that tiles are views of their map.
+
+    Positions are stored as tile indices, or -1 for dots that aren't on the
+    map yet.  Routes are never modified.  Instead, each dot keeps a cursor
+    that counts how many steps of its route are left, and moves to the tile
+    just before its cursor on every step.  Only dots with steps left are
+    looked at when the store is advanced.
+
+    Every dot starts out in a store of its own, is moved into its world's
+    store when it's added to the world, and is moved back out into a store
+    of its own when it's removed. """
+
+    def __init__(self, map, world=None):
+        self.map = map
+        self.world = world
+
+        self.positions = array('l')
+        self.progress = array('d')
+        self.speeds = array('d')
+        self.cursors = array('l')
+
+        self.routes = []
+        self.targets = []
+        self.planners = []
+        self.dots = []
+
+        # The dots that still have steps left in their routes, and the dots
+        # that have planners.  Both are kept up to date as dots change, so
+        # that neither group has to be found by looking at every dot.
+        self.moving = set()
+        self.planned = set()
+
+    def __len__(self):
+        return len(self.dots)
+
+    def get_map(self):
+        return self.map
+    def get_world(self):
+        return self.world
     def get_dots(self):
         return self.dots
+    def get_planned_dots(self):
+        dots = self.dots
+        return [dots[id] for id in sorted(self.planned)]
 
-# Dot {{{1
-class Dot:
+    def add(self, dot, position=-1, speed=500, progress=0,
+            route=None, target=None, planner=None):
+        """ Adds an entry for the given dot and returns its id.  This is a
+        private method, called by Dot and adopt(). """
 
-    def __init__(self, map):
-        self.position = None
+        id = len(self.dots)
+        route = route or []
+
+        self.positions.append(position)
+        self.progress.append(progress)
+        self.speeds.append(speed)
+        self.cursors.append(len(route))
+
+        self.routes.append(route)
+        self.targets.append(target)
+        self.planners.append(planner)
+        self.dots.append(dot)
+
+        if route: self.moving.add(id)
+        if planner: self.planned.add(id)
+        return id
+
+    def adopt(self, dot):
+        """ Moves the given dot out of whatever store it's in and into this
+        one, without changing any of its state. """
+
+        store, id = dot.store, dot.id
+        route = store.routes[id][:store.cursors[id]]
+
+        new_id = self.add(dot, store.positions[id], store.speeds[id],
+                store.progress[id],
+                route, store.targets[id], store.planners[id])
+
+        store.discard(id)
+        dot.store, dot.id = self, new_id
+
+    def remove(self, dot):
+        """ Takes the given dot out of this store.  The dot keeps its state
+        in a new store of its own, like a dot that was never added to a
+        world.  The last dot in this store takes its place, so the order of
+        the dots changes. """
+
+        assert dot.store is self
+        DotStore(self.map).adopt(dot)
+
+    def discard(self, id):
+        """ Removes the entry with the given id.  The last entry is moved
+        into the gap, so only that one dot is renumbered.  This is a private
+        method and should not be called outside this class. """
 
-        self.speed = 500
-        self.progress = 0
+        arrays = (self.positions, self.progress, self.speeds, self.cursors,
+                  self.routes, self.targets, self.planners, self.dots)
 
-        self.route = []
-        self.target = None
+        last = len(self.dots) - 1
+
+        self.moving.discard(id)
+        self.planned.discard(id)
+
+        if id != last:
+            for array in arrays:
+                array[id] = array[last]
+
+            self.dots[id].id = id
+
+            for ids in self.moving, self.planned:
+                if last in ids:
+                    ids.remove(last)
+                    ids.add(id)
+
+        for array in arrays:
+            array.pop()
+
+    def step(self, time, ids=None):
+        """ Advances the given dots, or every moving dot, by the given amount
+        of time.  A dot takes the next step of its route once it's been
+        moving for longer than its speed, and forgets its target once it
+        runs out of steps. """
+
+        positions = self.positions
+        progress = self.progress
+        speeds = self.speeds
+        cursors = self.cursors
+
+        routes = self.routes
+        moving = self.moving
+
+        occupancy = self.world.get_occupancy() if self.world else None
+        arrived = []
+
+        for id in moving if ids is None else ids:
+            if not cursors[id]: continue
+
+            progress[id] += time
+            if progress[id] <= speeds[id]: continue
+
+            cursor = cursors[id] = cursors[id] - 1
+            previous = positions[id]
+            position = positions[id] = routes[id][cursor].get_index()
+            progress[id] = 0
+
+            if occupancy:
+                dot = self.dots[id]
+                occupancy.remove_index(dot, previous)
+                occupancy.add_index(dot, position)
+
+            if not cursor: arrived.append(id)
+
+        for id in arrived:
+            self.targets[id] = None
+            moving.discard(id)
+# }}}1
+
+# Dot {{{1
+class Dot(object):
+    """ A view of one dot in a DotStore. """
+
+    __slots__ = ('store', 'id')
+
+    def __init__(self, map):
+        self.store = DotStore(map)
+        self.id = self.store.add(self)
 
     def load(self, position):
-        self.position = position
+        self.move(position)
 
-    def update(self, time):
-        if not self.route:
-            return
+    def move(self, position):
+        store = self.store
+        previous = self.get_position()
 
-        self.progress += time
-        if self.progress > self.speed:
-            self.position = self.route.pop()
-            self.progress = 0
+        store.positions[self.id] = \
+                position.get_index() if position is not None else -1
 
-        if not self.route:
-            self.target = None
+        if store.world: store.world.dot_moved(self, previous)
+
+    def update(self, time):
+        self.store.step(time, [self.id])
 
     def get_position(self):
-        return self.position
+        store = self.store
+        index = store.positions[self.id]
+        return store.map.get_node(index) if index >= 0 else None
     def get_route(self):
-        return self.route
+        store = self.store
+        return store.routes[self.id][:store.cursors[self.id]]
+    def get_next_position(self):
+        """ Returns the tile this dot is moving onto, or None if it isn't
+        moving. """
+        store = self.store
+        cursor = store.cursors[self.id]
+        return store.routes[self.id][cursor - 1] if cursor else None
     def get_target(self):
-        return self.target
+        return self.store.targets[self.id]
+    def get_planner(self):
+        return self.store.planners[self.id]
+    def get_speed(self):
+        return self.store.speeds[self.id]
+    def get_progress(self):
+        return self.store.progress[self.id]
+    def get_world(self):
+        return self.store.world
 
     def set_route(self, loop, route):
-        self.route = route
+        store = self.store
+        store.routes[self.id] = route
+        store.cursors[self.id] = len(route)
+
+        if route: store.moving.add(self.id)
+        else: store.moving.discard(self.id)
     def set_target(self, loop, target):
-        self.target = target
+        self.store.targets[self.id] = target
+    def set_planner(self, loop, planner):
+        store = self.store
+        store.planners[self.id] = planner
+
+        if planner: store.planned.add(self.id)
+        else: store.planned.discard(self.id)
+    def set_speed(self, speed):
+        self.store.speeds[self.id] = speed
 # }}}1
 
 # Tile {{{1
 class Tile(graph.Node):
+    """ A view of one tile.  The state of every tile is stored in arrays that
+    belong to its map, and a tile only knows its map and its index into those
+    arrays.  Tiles are created by their map and can't exist without one. """
 
-    def __init__(self, row, column, offset):
-        graph.Node.__init__(self, 1)
+    __slots__ = ()
 
-        self.row = row
-        self.column = column
-        self.offset = offset
+    def __init__(self, map, index):
+        self.graph = map
+        self.index = index
 
     def get_row(self):
-        return self.row
+        return self.graph.tile_rows[self.index]
     def get_column(self):
-        return self.column
+        return self.graph.tile_columns[self.index]
     def get_offset(self):
-        return self.offset
+        return self.graph.offsets[self.get_row()]
 
     def get_position(self):
-        return (self.row, self.column)
+        map = self.graph; index = self.index
+        return (map.tile_rows[index], map.tile_columns[index])
+
+    def get_axial(self):
+        map = self.graph; index = self.index
+        return (map.axial_q[index], map.axial_r[index])
+    def get_cube(self):
+        q, r = self.get_axial()
+        return (q, -q - r, r)
+
+    def get_weight(self):
+        return self.graph.weights[self.index]
+    def set_weight(self, weight):
+        self.graph.weights[self.index] = weight
+        self.graph.weight_changed(self)
+
+    def is_active(self):
+        return self.graph.active[self.index] != 0
+
+    def activate(self):
+        self.graph.active[self.index] = 1
+        self.graph.activity_changed(self)
+    def deactivate(self):
+        self.graph.active[self.index] = 0
+        self.graph.activity_changed(self)
 
 class ClearTile(Tile):
-    def __init__(self, row, column, offset):
-        Tile.__init__(self, row, column, offset)
-        self.activate()
+    """ A tile that started out passable. """
+    __slots__ = ()
 
 class ImpassableTile(Tile):
-    def __init__(self, row, column, offset):
-        Tile.__init__(self, row, column, offset)
-        self.deactivate()
+    """ A tile that started out impassable. """
+    __slots__ = ()
+
+class ChunkTile(Tile):
+    """ A tile in a ChunkedMap.  Chunked maps don't keep the position of
+    every tile, so these tiles remember their own.  The same tile may be
+    created more than once, so they're compared by position rather than by
+    identity. """
+
+    __slots__ = ('row', 'column')
+
+    def __init__(self, map, index, row, column):
+        Tile.__init__(self, map, index)
+        self.row = row
+        self.column = column
+
+    def __eq__(self, other):
+        return isinstance(other, ChunkTile) and \
+                self.row == other.row and self.column == other.column
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash((self.row, self.column))
+
+    def get_row(self):
+        return self.row
+    def get_column(self):
+        return self.column
+    def get_position(self):
+        return (self.row, self.column)
 
 # Map {{{1
 class Map(graph.SparseGraph):
 
+    # Offsets from a tile to its neighbors, as (dx, dy) pairs.  Which table
+    # applies depends on whether or not the tile's row is offset.
+    behind = [(-1, -1), (0, -1), (-1, 0),  (1, 0), (-1, 1),  (0, 1)]
+    in_front = [(0, -1), (1, -1), (-1, 0),  (1, 0), (0, 1),  (1, 1)]
+
+    # Translates map file characters into activity flags.
+    activity = ''.join('\0' if chr(code) == ' ' else '\1'
+                       for code in range(256))
+
     # Constructor {{{2
     def __init__(self):
         graph.SparseGraph.__init__(self)
@@ -102,7 +478,36 @@ class Map(graph.SparseGraph):
         self.rows = 0
         self.columns = 0
 
+        # The index of each row's first tile, the number of tiles in each
+        # row, and the axial shift of each row.
+        self.starts = array('l')
+        self.lengths = array('l')
+        self.shifts = []
+
+        # The state of every tile, by index.  Tiles are just views of these.
+        self.tile_rows = array('l')
+        self.tile_columns = array('l')
+        self.weights = array('d')
+        self.active = bytearray()
+        self.axial_q = array('l')
+        self.axial_r = array('l')
+
         self.home_tile = None
+        self.min_cost = 1
+        self.uniform = True
+
+        self.compact = None
+
+        # Implicit maps find neighbors with the steps listed for each row.
+        self.implicit = False
+        self.steps = []
+
+        # Tightens the heuristic on weighted maps (see landmarks.py).  The
+        # version goes up whenever the heuristic changes for reasons other
+        # than the minimum cost, so that searches which keep their queues
+        # between calls know to start over.
+        self.landmarks = None
+        self.heuristic_version = 0
 
     # Attributes {{{2
     def get_map(self):
@@ -121,8 +526,41 @@ class Map(graph.SparseGraph):
         except IndexError:
             raise NoSuchTile()
 
+    def find_tile(self, row, column):
+        """ Returns the tile in the given position, or None if there isn't
+        one.  Unlike get_tile(), inactive tiles are returned. """
+
+        tiles = self.map.get(row)
+        return tiles.get(column) if tiles else None
+
+    def get_axial_tile(self, q, r):
+        """ Returns the tile at the given axial coordinates, or None if there
+        isn't one.  Unlike get_tile(), inactive tiles are returned. """
+
+        try: return self.map[r][q + self.shifts[r]]
+        except (KeyError, IndexError): return None
+
     def get_home_tile(self):
         return self.home_tile
+    def get_compact(self):
+        return self.compact
+    def is_compact(self):
+        return self.compact is not None
+    def is_implicit(self):
+        return self.implicit
+
+    def get_landmarks(self):
+        return self.landmarks
+    def set_landmarks(self, landmarks):
+        if self.landmarks: self.remove_listener(self.landmarks)
+        if landmarks: self.add_listener(landmarks)
+        self.landmarks = landmarks
+        self.heuristic_changed()
+
+    def get_heuristic_version(self):
+        return self.heuristic_version
+    def heuristic_changed(self):
+        self.heuristic_version += 1
 
     def get_width(self):
         return self.columns
@@ -130,10 +568,286 @@ class Map(graph.SparseGraph):
         return self.rows
     def get_dimensions(self):
         return (self.columns, self.rows)
+
+    def get_starts(self):
+        return self.starts
+    def get_lengths(self):
+        return self.lengths
+    def get_positions(self):
+        return self.tile_rows, self.tile_columns
+    def get_weights(self):
+        return self.weights
+    def get_active(self):
+        return self.active
+    def get_axial(self):
+        return self.axial_q, self.axial_r
     # }}}2
 
+    def get_distance(self, start, end):
+        """ Returns the number of steps between two tiles, ignoring any
+        obstacles in the way. """
+
+        q = self.axial_q; r = self.axial_r
+        start = start.get_index(); end = end.get_index()
+
+        dq = q[start] - q[end]; dr = r[start] - r[end]
+        return (abs(dq) + abs(dr) + abs(dq + dr)) // 2
+
     def heuristic(self, end, target):
-        return 0
+        return self.index_heuristic(end.get_index(), target.get_index())
+
+    def index_heuristic(self, end, target):
+        """ Same as heuristic(), but takes node indices rather than tiles. """
+
+        if self.min_cost is None: self.measure_weights()
+
+        q = self.axial_q; r = self.axial_r
+        dq = q[end] - q[target]; dr = r[end] - r[target]
+        estimate = (abs(dq) + abs(dr) + abs(dq + dr)) // 2 * self.min_cost
+
+        if self.landmarks:
+            bound = self.landmarks.get_bound(self, end, target)
+            if bound > estimate: return bound
+
+        return estimate
+
+    def get_min_cost(self):
+        if self.min_cost is None: self.measure_weights()
+        return self.min_cost
+
+    def is_uniform(self):
+        """ Returns true if every tile has the same weight. """
+        if self.uniform is None: self.measure_weights()
+        return self.uniform
+
+    def measure_weights(self):
+        """ Finds the cheapest possible step between two tiles, which is used
+        to keep the heuristic admissible, and whether or not every step costs
+        the same. """
+
+        weights = set(self.weights) or set([1])
+        weight = min(weights)
+
+        self.min_cost = weight * weight
+        self.uniform = (len(weights) == 1)
+
+    def weight_changed(self, tile):
+        graph.SparseGraph.weight_changed(self, tile)
+
+        # A cheaper tile can be accounted for right away, but any other change
+        # might have raised the minimum, so the map has to be measured again.
+        weight = tile.get_weight()
+        if self.min_cost is not None and weight * weight < self.min_cost:
+            self.min_cost = weight * weight
+        else:
+            self.min_cost = None
+
+        self.uniform = None
+
+        if self.compact:
+            self.compact.set_weight(tile.get_index(), weight)
+
+    def activity_changed(self, tile):
+        graph.SparseGraph.activity_changed(self, tile)
+
+        if self.compact:
+            self.compact.set_active(tile.get_index(), tile.is_active())
+
+    # Regions {{{2
+
+    # Regions are lists of tile indices, so they can be used to index the
+    # tile arrays directly.
+
+    def get_rectangle(self, top, left, bottom, right):
+        """ Returns the indices of the tiles in the given rows and columns.
+        Like a slice, the bottom row and the right column are left out. """
+
+        indices = []
+
+        for row in range(max(top, 0), min(bottom, self.rows)):
+            start = self.starts[row]
+            end = min(right, self.lengths[row])
+            indices.extend(range(start + max(left, 0), start + end))
+
+        return indices
+
+    def get_hexagon(self, center, radius):
+        """ Returns the indices of the tiles that are no more than the given
+        number of steps away from the given tile. """
+
+        q, r = center.get_axial()
+        indices = []
+
+        for dr in range(-radius, radius + 1):
+            row = r + dr
+            if not 0 <= row < self.rows: continue
+
+            # Axial q coordinates become columns by adding the row's shift.
+            shift = self.shifts[row]
+            first = q + max(-radius, -dr - radius) + shift
+            last = q + min(radius, -dr + radius) + shift
+
+            start = self.starts[row]
+            end = min(last + 1, self.lengths[row])
+            indices.extend(range(start + max(first, 0), start + end))
+
+        return indices
+
+    def get_mask(self, indices):
+        """ Returns a bytearray with an entry for every tile, which is set
+        for the given tiles and clear for every other one. """
+
+        mask = bytearray(len(self.weights))
+        for index in indices: mask[index] = 1
+        return mask
+
+    def get_masked(self, mask):
+        """ Returns the indices that are set in the given mask. """
+        return [index for index, selected in enumerate(mask) if selected]
+
+    def select(self, indices, active=None, lightest=None, heaviest=None):
+        """ Returns the given indices whose tiles match every given criteria.
+        Tiles can be selected by whether or not they're active, and by the
+        lightest and heaviest weights allowed. """
+
+        weights = self.weights
+        flags = self.active
+
+        if active is not None:
+            indices = [index for index in indices
+                       if (flags[index] != 0) == active]
+        if lightest is not None:
+            indices = [index for index in indices if weights[index] >= lightest]
+        if heaviest is not None:
+            indices = [index for index in indices if weights[index] <= heaviest]
+
+        return list(indices)
+    # }}}2
+
+    # Bulk Updates {{{2
+    def set_weights(self, indices, weight):
+        weights = self.weights
+        indices = list(indices)
+
+        for index in indices:
+            weights[index] = weight
+
+        self.tiles_changed(indices)
+
+    def scale_weights(self, indices, factor):
+        weights = self.weights
+        indices = list(indices)
+
+        for index in indices:
+            weights[index] *= factor
+
+        self.tiles_changed(indices)
+
+    def set_activity(self, indices, active):
+        flags = self.active
+        flag = 1 if active else 0
+        indices = list(indices)
+
+        for index in indices:
+            flags[index] = flag
+
+        self.tiles_changed(indices)
+
+    def tiles_changed(self, indices):
+        """ Like calling weight_changed() and activity_changed() for every
+        given tile, except that the map is only remeasured once. """
+
+        self.generation += 1
+        self.min_cost = self.uniform = None
+
+        compact = self.compact
+        weights = self.weights
+        flags = self.active
+
+        if compact:
+            for index in indices:
+                compact.set_weight(index, weights[index])
+                compact.set_active(index, flags[index])
+
+        if self.listeners:
+            for index in indices:
+                tile = self.get_node(index)
+                for listener in self.listeners:
+                    listener.node_changed(tile)
+    # }}}2
+
+    # Edge Views {{{2
+
+    # Compact and implicit maps don't store any Edge objects.  Instead, these
+    # methods create them on the fly, either from the compact adjacency arrays
+    # or straight from the neighbor tables.
+
+    def get_neighbors(self, node, cache_ok=True):
+        """ Returns the tiles next to the given one.  Like make_edges(), a
+        tile is connected to every tile in its own neighbor table, and to
+        every tile that has it in theirs. """
+
+        if not self.implicit:
+            return graph.SparseGraph.get_neighbors(self, node, cache_ok)
+
+        row, column = node.get_position()
+        find_tile = self.find_tile
+        neighbors = []
+
+        for dx, dy in self.steps[row]:
+            neighbor = find_tile(row + dy, column + dx)
+            if neighbor is not None: neighbors.append(neighbor)
+
+        return neighbors
+
+    def get_edges_from(self, node):
+        if self.compact:
+            return self.compact.get_edges_from(node)
+        if self.implicit:
+            Edge = graph.Edge
+            return [Edge(node, neighbor)
+                    for neighbor in self.get_neighbors(node)]
+        return graph.SparseGraph.get_edges_from(self, node)
+
+    def get_edge(self, start, end):
+        if self.compact:
+            return self.compact.get_edge(start, end)
+        if self.implicit:
+            if end not in self.get_neighbors(start):
+                raise KeyError(end)
+            return graph.Edge(start, end)
+        return graph.SparseGraph.get_edge(self, start, end)
+
+    def get_all_edges(self):
+        if self.compact or self.implicit:
+            return [edge for node in self
+                    for edge in self.get_edges_from(node)]
+        return graph.SparseGraph.get_all_edges(self)
+
+    def get_num_edges(self):
+        if self.compact:
+            return self.compact.get_num_edges()
+        if self.implicit:
+            return sum(len(self.get_neighbors(node)) for node in self)
+        return graph.SparseGraph.get_num_edges(self)
+
+    def get_adjacency(self):
+        """ Returns the offsets, neighbors and costs of every edge in the same
+        form as graph.CompactGraph.  Compact maps return their own arrays,
+        and every other map builds them from its edges. """
+
+        if self.compact:
+            return self.compact.get_arrays()[:3]
+
+        offsets, neighbors, costs = array('l', [0]), array('i'), array('d')
+
+        for index in range(self.get_num_nodes()):
+            for edge in self.get_edges_from(self.get_node(index)):
+                neighbors.append(edge.get_end().get_index())
+                costs.append(edge.get_cost())
+            offsets.append(len(neighbors))
+
+        return offsets, neighbors, costs
 
     # Load From File {{{2
 
@@ -146,12 +860,18 @@ class Map(graph.SparseGraph):
     #    for each line, because some spaces are significant.
     #
     # 3. Create a grid of tiles.  Each tile needs to know its position in
-    #    the grid and the offset of its row.
+    #    the grid and the offset of its row.  The offsets are also used to
+    #    give each tile axial hex coordinates, for measuring distances.
     # 
     # 4. Create edges to connect the nodes.  This also requires the offset
-    #    data, because it will affect the inter-row connectivity.
+    #    data, because it will affect the inter-row connectivity.  Compact
+    #    maps store their edges in arrays rather than as Edge objects, and
+    #    implicit maps don't store them at all.
+    #
+    # Compiled maps (see mapfile.py) skip the first two steps, and compact
+    # compiled maps skip the last one as well.
         
-    def load(self, path):
+    def load(self, path, compact=False, cache=False, implicit=False):
         """ Builds this map object from the provided file.  The file format
         should be as follows:
         
@@ -162,17 +882,124 @@ class Map(graph.SparseGraph):
         restrictions will make the text look like a hexagonal grid. 
 
         If these restrictions are not followed, the code will probably break
-        in unpredictable ways.  There is almost no error-checking. """
+        in unpredictable ways.  There is almost no error-checking. 
+        
+        If compact is true, the edges are stored in a graph.CompactGraph
+        rather than as individual Edge objects.  This uses much less memory
+        and allows the map to be searched with pathfinding.CompactA_Star.
 
-        self.map = {}
-        self.rows = self.columns = 0
+        If implicit is true, no edges are stored at all.  Instead, neighbors
+        are found from the offset tables whenever they're asked for.  This
+        uses the least memory, but every search step is a little slower.
+
+        Compiled map files are loaded directly.  If cache is true and the
+        path is a .hex file, its compiled file is used instead whenever it's
+        up to date, and is written (or rewritten) otherwise.
+
+        If landmarks have been saved next to the map, they're used to improve
+        the heuristic. """
+
+        self.find_landmarks(path)
+
+        if path.endswith(mapfile.extension):
+            return self.load_compiled(
+                    mapfile.MapFile(path), compact, implicit)
+
+        if cache:
+            compiled = mapfile.get_compiled_path(path)
+
+            try:
+                file = mapfile.MapFile(compiled)
+                if not file.is_stale(path):
+                    return self.load_compiled(file, compact, implicit)
+            except (IOError, mapfile.MapFileError):
+                pass
+
+        self.clear()
 
         # Extracting tile data from the file:
         tiles, offsets = self.read_file(path)
 
+        # Filling the tile arrays:
+        self.measure_rows([len(line) for line in tiles], offsets)
+        self.make_positions()
+        self.make_arrays(tiles)
+
         # Storing new nodes in the graph:
-        self.make_nodes(tiles, offsets)
-        self.make_edges(offsets)
+        self.make_nodes(tiles)
+
+        if compact: self.make_compact_edges(offsets)
+        elif implicit: self.make_implicit_edges()
+        else: self.make_edges(offsets)
+
+        self.measure_weights()
+
+        # Failing to write the cache shouldn't stop the game.
+        if cache:
+            try: mapfile.write(compiled, self, path)
+            except (IOError, OSError): pass
+
+    def load_compiled(self, file, compact=False, implicit=False):
+        """ Builds this map object from a mapfile.MapFile.  The tiles are the
+        same as if the original .hex file had been loaded.  The weight,
+        activity and axial arrays are views into the file, so they aren't
+        copied.  This is a private method and should not be called outside
+        this class. """
+
+        self.clear()
+
+        tiles, offsets = file.get_lines(), file.get_offsets()
+
+        self.measure_rows(file.get_lengths(), offsets)
+        self.make_positions(axial=False)
+
+        self.weights = file.get_weights()
+        self.active = file.get_active()
+        self.axial_q, self.axial_r = file.get_axial()
+
+        self.make_nodes(tiles)
+
+        home = file.get_home()
+        if home: self.home_tile = self.map[home[0]][home[1]]
+
+        if compact and file.has_adjacency():
+            edge_offsets, neighbors, costs = file.get_adjacency()
+
+            self.compact = graph.CompactGraph(
+                    self.nodes, edge_offsets, neighbors,
+                    self.weights, self.active, costs)
+
+        elif compact: self.make_compact_edges(offsets)
+        elif implicit: self.make_implicit_edges()
+        else: self.make_edges(offsets)
+
+        self.measure_weights()
+
+    def find_landmarks(self, path):
+        """ Uses the landmarks saved next to the given map file, if there are
+        any.  They aren't read until the heuristic first needs them.  This is
+        a private method and should not be called outside this class. """
+
+        table = landmarks.get_landmarks_path(path)
+
+        if os.path.exists(table):
+            source = os.path.splitext(path)[0] + '.hex'
+            self.set_landmarks(landmarks.Landmarks(table, source))
+        else:
+            self.set_landmarks(None)
+
+    def clear(self):
+        """ Forgets every tile and edge, so that a new map can be loaded.
+        This is a private method and should not be called outside this
+        class. """
+
+        self.map = {}
+        self.nodes = []
+        self.edges = {}
+
+        self.compact = None
+        self.implicit = False
+        self.home_tile = None
 
     def read_file(self, path):
         """ Reads data from the given map file into memory.  This is a private
@@ -181,58 +1008,90 @@ class Map(graph.SparseGraph):
         tiles = []
         offsets = []
 
-        with open(path) as file:
-            for line in file:
+        for relevant_tiles, offset in read_rows(path):
+            tiles.append(relevant_tiles)
+            offsets.append(offset)
 
-                # Ignore empty lines and comments.
-                line = line.rstrip().upper()
-                if not line or line[0] == '#':
-                    continue
+        return tiles, offsets
 
-                # Determine whether or not this line is offset.
-                leading_tile = line.index('F')
-                offset = (leading_tile % 2 == 1)
+    def measure_rows(self, lengths, offsets):
+        """ Records the size, offset and position of each row.  This is a
+        private method and should not be called outside this class. """
 
-                # Prune irrelevant characters from the line.
-                relevant_tiles = ""
-                for index, character in enumerate(line):
-                    if (index % 2) == (leading_tile % 2):
-                        relevant_tiles += character
+        self.offsets = list(offsets)
+        self.lengths = array('l', lengths)
 
-                # Save information about the map.
-                tiles.append(relevant_tiles)
-                offsets.append(offset)
+        self.rows = len(self.lengths)
+        self.columns = max(self.lengths or [0])
 
-                self.rows += 1
-                self.columns = max(self.columns, len(relevant_tiles))
+        # Each offset row shifts the axial q coordinate of the rows below it.
+        # This follows the neighbor tables in make_edges(): below an offset
+        # row, the tile in the same column is up and to the right.
+        self.starts = array('l')
+        self.shifts = []
+        start = shift = 0
 
-        self.offsets = offsets
-        return tiles, offsets
+        for length, offset in zip(self.lengths, self.offsets):
+            self.starts.append(start)
+            self.shifts.append(shift)
 
-    def make_nodes(self, tiles, offsets):
-        """ Creates graph nodes based on the information read out of the map
-        file.  This is a private method and should not be called outside this
+            start += length
+            if offset: shift += 1
+
+    def make_positions(self, axial=True):
+        """ Fills in the position of every tile, and optionally its axial
+        coordinates as well.  This is a private method and should not be
+        called outside this class. """
+
+        self.tile_rows = tile_rows = array('l')
+        self.tile_columns = tile_columns = array('l')
+
+        if axial:
+            self.axial_q = axial_q = array('l')
+            self.axial_r = axial_r = array('l')
+
+        for row, (length, shift) in enumerate(zip(self.lengths, self.shifts)):
+            columns = range(length)
+
+            tile_rows.extend([row] * length)
+            tile_columns.extend(columns)
+
+            if axial:
+                axial_q.extend(range(-shift, length - shift))
+                axial_r.extend([row] * length)
+
+    def make_arrays(self, tiles):
+        """ Fills in the weight and activity of every tile.  Every tile starts
+        out with a weight of one, and only the impassable tiles are inactive.
+        This is a private method and should not be called outside this
         class. """
 
-        row = 0
+        characters = ''.join(tiles)
+
+        self.weights = array('d', [1]) * len(characters)
+        self.active = bytearray(characters.translate(self.activity))
+
+    def make_nodes(self, tiles):
+        """ Creates a view for every tile, and finds the home tile.  This is
+        a private method and should not be called outside this class. """
+
         map = self.map
+        nodes = self.nodes
+        index = 0
 
-        for line, offset in zip(tiles, offsets):
-            column = 0
-            map[row] = {}
+        for row, line in enumerate(tiles):
+            map[row] = tiles_by_column = {}
 
-            for character in line:
+            for column, character in enumerate(line):
                 if character == ' ':
-                    tile = ImpassableTile(row, column, offset)
+                    tile = ImpassableTile(self, index)
                 else:
-                    tile = ClearTile(row, column, offset)
+                    tile = ClearTile(self, index)
                     if character == 'H': self.home_tile = tile
 
-                self.add_node(tile)
-                map[row][column] = tile
-
-                column += 1
-            row += 1
+                nodes.append(tile)
+                tiles_by_column[column] = tile
+                index += 1
 
     def make_edges(self, offsets):
         """ Creates graph edges based on the data read out of the map file.
@@ -240,30 +1099,285 @@ class Map(graph.SparseGraph):
         is a private method and should not be called from outside of this
         class. """
 
-        behind = [(-1, -1), (0, -1), (-1, 0),  (1, 0), (-1, 1),  (0, 1)]
-        in_front = [(0, -1), (1, -1), (-1, 0),  (1, 0), (0, 1),  (1, 1)]
+        behind = self.behind
+        in_front = self.in_front
 
         map = self.map
-        add_edge = self.add_edge
+        edges = self.edges
+        Edge = graph.Edge
 
+        # This does the same thing as calling add_edge() in both directions,
+        # but it only creates Edge objects that will actually be kept.
         for tile in self.get_nodes():
             y, x = tile.get_position()
 
             offset = offsets[y]
             neighbors = in_front if offset else behind
 
-            for data in neighbors:
-                try:
-                    dx, dy = data
-                    neighbor = map[y + dy][x + dx]
+            edges_from = edges.setdefault(tile, {})
+
+            for dx, dy in neighbors:
+                row = map.get(y + dy)
+                neighbor = row.get(x + dx) if row else None
+                if neighbor is None: continue
+
+                if neighbor not in edges_from:
+                    edges_from[neighbor] = Edge(tile, neighbor)
+
+                edges_to = edges.setdefault(neighbor, {})
+                if tile not in edges_to:
+                    edges_to[tile] = Edge(neighbor, tile)
+
+    def make_compact_edges(self, offsets):
+        """ Creates the same connectivity as make_edges(), but stores it in a
+        graph.CompactGraph.  Like make_edges(), every neighbor found in the
+        offset tables is connected in both directions.  The compact graph
+        shares this map's weight and activity arrays.  This is a private
+        method and should not be called from outside of this class. """
+
+        starts = self.starts
+        lengths = self.lengths
+        rows = self.rows
+
+        tile_rows = self.tile_rows
+        tile_columns = self.tile_columns
+
+        adjacency = [[] for index in range(len(tile_rows))]
+
+        for index in range(len(tile_rows)):
+            y = tile_rows[index]; x = tile_columns[index]
+
+            offset = offsets[y]
+            neighbors = self.in_front if offset else self.behind
+
+            for dx, dy in neighbors:
+                row = y + dy; column = x + dx
+                if not 0 <= row < rows: continue
+                if not 0 <= column < lengths[row]: continue
+
+                neighbor = starts[row] + column
+
+                if neighbor not in adjacency[index]:
+                    adjacency[index].append(neighbor)
+                if index not in adjacency[neighbor]:
+                    adjacency[neighbor].append(index)
+
+        row_offsets = array('l', [0])
+        neighbors = array('i')
+
+        for indices in adjacency:
+            neighbors.extend(indices)
+            row_offsets.append(len(neighbors))
 
-                    add_edge(graph.Edge(tile, neighbor))
-                    add_edge(graph.Edge(neighbor, tile))
+        self.compact = graph.CompactGraph(
+                self.nodes, row_offsets, neighbors, self.weights, self.active)
 
-                except KeyError:
-                    pass
+    def make_implicit_edges(self):
+        """ Lists the steps from the tiles in each row to their neighbors,
+        instead of creating any edges.  A tile's neighbors are the tiles in
+        its own offset table, and the tiles that have it in theirs.  That only
+        depends on whether the row and the rows next to it are offset, so
+        rows that are alike share the same list.  This is a private method
+        and should not be called from outside of this class. """
+
+        offsets = self.offsets
+        rows = self.rows
+
+        def get_table(row):
+            return self.in_front if offsets[row] else self.behind
+
+        lists = {}
+        self.steps = []
+
+        for row in range(rows):
+            others = [other for other in (row - 1, row, row + 1)
+                      if 0 <= other < rows]
+            key = tuple((other - row, offsets[other]) for other in others)
+
+            steps = lists.get(key)
+
+            if steps is None:
+                steps = list(get_table(row))
+
+                for other in others:
+                    for dx, dy in get_table(other):
+                        step = (-dx, other - row)
+                        if other + dy == row and step not in steps:
+                            steps.append(step)
+
+                lists[key] = steps
+
+            self.steps.append(steps)
+
+        self.implicit = True
 # }}}1
 
+# Chunked Map {{{1
+class ChunkedMap(Map):
+    """ A map that only creates tiles when they're needed, for maps that are
+    too big to load.  The map is read from a compiled map file (see
+    mapfile.py), which is memory-mapped rather than loaded, and is divided
+    into square chunks of tiles.  The tiles in a chunk are created the first
+    time any of them are touched, and the least recently used chunks are
+    dropped once there are more than the given capacity.
+
+    Like an implicit Map, edges aren't stored at all, but are created
+    whenever they're asked for.  Searches reach them through expand_node(),
+    so chunks are loaded as a search spreads into them.  Tiles are views of
+    the copy-on-write mapping, so changes to them survive their chunk being
+    dropped.  Since a tile may be recreated, any references to old tiles
+    still compare equal to the new ones, and see the same state. """
+
+    def __init__(self, size=32, capacity=64):
+        Map.__init__(self)
+
+        self.size = size
+        self.chunks = trees.LRUCache(capacity)
+
+        self.file = None
+
+    def __iter__(self):
+        """ Yields every tile, one chunk at a time. """
+
+        size = self.size
+
+        for chunk_row in range(0, self.rows, size):
+            for chunk_column in range(0, self.columns, size):
+                key = chunk_row // size, chunk_column // size
+
+                for tiles in self.get_chunk(key):
+                    for tile in tiles:
+                        yield tile
+
+    # Attributes {{{2
+    def get_size(self):
+        return self.size
+    def get_chunks(self):
+        return self.chunks
+    def get_capacity(self):
+        return self.chunks.get_capacity()
+    def set_capacity(self, capacity):
+        self.chunks.set_capacity(capacity)
+
+    def get_chunk(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None: chunk = self.load_chunk(key)
+        return chunk
+
+    def find_tile(self, row, column):
+        """ Returns the tile in the given position, creating it if necessary,
+        or None if there isn't one.  Unlike get_tile(), inactive tiles are
+        returned. """
+
+        if not 0 <= row < self.rows: return None
+        if not 0 <= column < self.lengths[row]: return None
+
+        size = self.size
+        chunk = self.get_chunk((row // size, column // size))
+        return chunk[row % size][column % size]
+
+    def get_tile(self, row, column):
+        tile = self.find_tile(row, column)
+
+        if tile is None: raise NoSuchTile()
+        if not tile.is_active(): raise InactiveTile(tile)
+        return tile
+
+    def get_axial_tile(self, q, r):
+        if not 0 <= r < self.rows: return None
+        return self.find_tile(r, q + self.shifts[r])
+
+    def get_node(self, index):
+        row = bisect_right(self.starts, index) - 1
+        return self.find_tile(row, index - self.starts[row])
+    def get_nodes(self):
+        return list(self)
+    def get_num_nodes(self):
+        return self.file.get_num_tiles()
+    # }}}2
+
+    # Edge Views {{{2
+    def expand_node(self, node):
+        """ Returns the edges from the given tile, loading the chunks of any
+        neighbors that aren't loaded yet. """
+        return self.get_edges_from(node)
+    # }}}2
+
+    # Load From File {{{2
+    def load(self, path):
+        """ Opens the given map without creating any tiles.  A .hex file is
+        compiled first, unless its compiled file is already up to date. """
+
+        self.find_landmarks(path)
+
+        if not path.endswith(mapfile.extension):
+            compiled = mapfile.get_compiled_path(path)
+
+            try: stale = mapfile.MapFile(compiled).is_stale(path)
+            except (IOError, mapfile.MapFileError): stale = True
+
+            if stale: mapfile.compile(path, compiled)
+            path = compiled
+
+        file = self.file = mapfile.MapFile(path)
+
+        # Tile positions aren't stored, since each tile remembers its own.
+        self.measure_rows(file.get_lengths(), file.get_offsets())
+        self.make_implicit_edges()
+
+        self.weights = file.get_weights()
+        self.active = file.get_active()
+        self.axial_q, self.axial_r = file.get_axial()
+
+        self.chunks.clear()
+        self.min_cost = self.uniform = None
+
+        home = file.get_home()
+        self.home_tile = self.find_tile(*home) if home else None
+
+    def load_chunk(self, key):
+        """ Creates the tiles in the given chunk, which is returned as a list
+        of rows.  This is a private method and should not be called outside
+        this class. """
+
+        size = self.size
+        first_row = key[0] * size
+        first_column = key[1] * size
+
+        chunk = []
+
+        for row in range(first_row, min(first_row + size, self.rows)):
+            start = self.starts[row]
+            last_column = min(first_column + size, self.lengths[row])
+
+            chunk.append([ChunkTile(self, start + column, row, column)
+                          for column in range(first_column, last_column)])
+
+        self.chunks.put(key, chunk)
+        return chunk
+    # }}}2
+# }}}1
+
+# Read Rows {{{1
+def read_rows(path):
+    """ Yields the tiles in each row of the given map file, along with whether
+    or not that row is offset.  Only one row is held in memory at a time. """
+
+    with open(path) as file:
+        for line in file:
+
+            # Ignore empty lines and comments.
+            line = line.rstrip().upper()
+            if not line or line[0] == '#':
+                continue
+
+            # Determine whether or not this line is offset.
+            leading_tile = line.index('F')
+            offset = (leading_tile % 2 == 1)
+
+            # Prune irrelevant characters from the line.
+            yield line[leading_tile % 2::2], offset
+
 # Tile Exception {{{1
 class TileException(Exception):
     pass
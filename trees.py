@@ -1,7 +1,16 @@
+import heapq
+import itertools
+
+from collections import OrderedDict
+
 class PriorityQueue(object):
+    """ Binary heap that keeps track of where each item lives, so that
+    membership tests are O(1) and update() (i.e. decrease-key) is O(log n).
+    Items must be hashable and may only appear in the queue once. """
+
     def __init__(self, compare=lambda a, b: a < b):
         self.heap = []
-        self.set = set()
+        self.positions = {}
         self.compare = compare
 
     def __len__(self):
@@ -9,37 +18,49 @@ class PriorityQueue(object):
     def __repr__(self):
         return str(self.heap)
     def __contains__(self, item):
-        return item in self.set
+        return item in self.positions
 
     def push(self, item):
         self.heap.append(item)
-        self.set.add(item)
+        self.positions[item] = len(self) - 1
 
         self.__bubble(len(self) - 1)
 
     def update(self, item):
-        index = self.heap.index(item)
-        self.__bubble(index)
+        index = self.positions[item]
+        if self.__bubble(index) == index:
+            self.__drip(index)
 
     def pop(self):
-        set = self.set
         heap = self.heap
-        compare = self.compare
-
-        size = len(self) - 1
+        positions = self.positions
 
-        if not size:
-            first = heap.pop()
-        else:
-            first = heap.pop(0)
-            last = heap.pop()
+        first = heap[0]
+        last = heap.pop()
 
-            heap.insert(0, last)
+        # Swap the last item into the root rather than shifting the list.
+        if heap:
+            heap[0] = last
+            positions[last] = 0
             self.__drip(0)
 
-        set.remove(first)
+        del positions[first]
         return first
 
+    def remove(self, item):
+        heap = self.heap
+        positions = self.positions
+
+        index = positions.pop(item)
+        last = heap.pop()
+
+        # Fill the hole with the last item, which may need to move either up
+        # or down from there.
+        if index < len(heap):
+            heap[index] = last
+            positions[last] = index
+            self.update(last)
+
     def peek(self):
         return self.heap[0]
     def empty(self):
@@ -47,34 +68,53 @@ class PriorityQueue(object):
 
     def __bubble(self, index):
         heap = self.heap
+        positions = self.positions
         compare = self.compare
 
+        item = heap[index]
         child = index
-        parent = (child - 1) / 2
 
-        while child and compare(heap[child], heap[parent]):
-            heap[child], heap[parent] = heap[parent], heap[child]
-            child, parent = parent, (parent - 1)/2
+        while child:
+            parent = (child - 1) // 2
+            if not compare(item, heap[parent]):
+                break
+
+            heap[child] = heap[parent]
+            positions[heap[child]] = child
+            child = parent
+
+        heap[child] = item
+        positions[item] = child
+
+        return child
 
     def __drip(self, index):
         heap = self.heap
+        positions = self.positions
         compare = self.compare
 
-        get_parent_child = lambda parent: (parent, 2 * parent + 1)
-        parent, child = get_parent_child(index)
+        item = heap[index]
+        parent = index
+        child = 2 * parent + 1
 
-        size = len(self) - 1
+        size = len(heap)
 
         while child < size:
-            if (child < size - 1) and compare(heap[child + 1], heap[child]):
+            if (child + 1 < size) and compare(heap[child + 1], heap[child]):
                 child += 1
 
-            if compare(heap[child], heap[parent]):
-                heap[child], heap[parent] = heap[parent], heap[child]
-                parent, child = get_parent_child(child)
-            else:
+            if not compare(heap[child], item):
                 break
 
+            heap[parent] = heap[child]
+            positions[heap[parent]] = parent
+            parent, child = child, 2 * child + 1
+
+        heap[parent] = item
+        positions[item] = parent
+
+        return parent
+
 class IndexedPQ(PriorityQueue):
     def __init__(self, weights, compare=lambda a, b: a < b):
         PriorityQueue.__init__(self, self.__compare)
@@ -86,6 +126,116 @@ class IndexedPQ(PriorityQueue):
         compare = self.naive_compare
         return compare(weights[a], weights[b])
 
+class LazyIndexedPQ(object):
+    """ Drop-in alternative to IndexedPQ built on heapq.  Rather than moving
+    an item when its weight changes, update() pushes a fresh entry and the
+    old one is discarded when it reaches the top of the heap.  Only the
+    natural ordering of the weights is supported. """
+
+    def __init__(self, weights):
+        self.heap = []
+        self.entries = {}
+        self.weights = weights
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+    def __repr__(self):
+        return str(sorted(self.entries, key=self.weights.__getitem__))
+    def __contains__(self, item):
+        return item in self.entries
+
+    def push(self, item):
+        count = next(self.counter)
+        self.entries[item] = count
+        heapq.heappush(self.heap, (self.weights[item], count, item))
+
+    def update(self, item):
+        self.push(item)
+
+    def pop(self):
+        self.__discard_stale()
+        weight, count, item = heapq.heappop(self.heap)
+
+        del self.entries[item]
+        return item
+
+    def remove(self, item):
+        del self.entries[item]
+
+    def peek(self):
+        self.__discard_stale()
+        return self.heap[0][2]
+    def empty(self):
+        return len(self) == 0
+
+    def __discard_stale(self):
+        heap = self.heap
+        entries = self.entries
+
+        while entries.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+
+class LRUCache(object):
+    """ Dictionary that holds at most a fixed number of items, evicting the
+    least recently used ones first.  Hits, misses and evictions are counted
+    so the capacity can be tuned. """
+
+    def __init__(self, capacity):
+        self.items = OrderedDict()
+        self.capacity = capacity
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+    def __repr__(self):
+        return str(self.items.keys())
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        items = self.items
+
+        if key not in items:
+            self.misses += 1
+            return default
+
+        # Move the item to the back of the line.
+        value = items.pop(key)
+        items[key] = value
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        items = self.items
+
+        if key in items:
+            del items[key]
+        items[key] = value
+
+        while len(items) > self.capacity:
+            items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.items.clear()
+
+    def get_capacity(self):
+        return self.capacity
+    def get_hits(self):
+        return self.hits
+    def get_misses(self):
+        return self.misses
+    def get_evictions(self):
+        return self.evictions
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+
 if __name__ == "__main__":
 
     from random import shuffle
@@ -120,7 +270,57 @@ if __name__ == "__main__":
         while queue:
             assert queue.pop() == months.pop()
 
+    def test_update(Queue):
+        values = range(1000)
+        shuffle(values)
+
+        weights = dict(zip(values, values))
+        queue = Queue(weights)
+
+        for value in values:
+            queue.push(value)
+
+        # Move some items towards the front of the queue and others towards
+        # the back, then check that the queue still comes out sorted.
+        for value in values[::2]:
+            weights[value] = -value
+            queue.update(value)
+        for value in values[1::4]:
+            weights[value] = 2000 + value
+            queue.update(value)
+
+        assert 0 in queue and 1000 not in queue
+
+        # Remove a few items from the middle of the queue.
+        for value in values[::7]:
+            queue.remove(value)
+
+        remaining = [value for index, value in enumerate(values) if index % 7]
+
+        result = [queue.pop() for value in remaining]
+        assert result == sorted(remaining, key=weights.get)
+        assert queue.empty()
+
+    def test_cache():
+        cache = LRUCache(2)
+
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+
+        # "b" is now the least recently used item.
+        cache.put("c", 3)
+        assert "b" not in cache
+        assert cache.get("b") is None
+
+        assert cache.get_hits() == 1
+        assert cache.get_misses() == 1
+        assert cache.get_evictions() == 1
+
     test_range()
     test_months()
+    test_update(IndexedPQ)
+    test_update(LazyIndexedPQ)
+    test_cache()
 
     print "All tests passed."
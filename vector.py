@@ -5,6 +5,11 @@ import random
 
 # A kick-ass 2D vector class.
 class Vector(object):
+
+    # Names in __slots__ are mangled like any other private name, so these
+    # are the same slots that self.__x and self.__y refer to.
+    __slots__ = ('__x', '__y')
+
     def __init__(self, x, y):
         self.__x = x
         self.__y = y